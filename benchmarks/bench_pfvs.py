@@ -0,0 +1,280 @@
+"""
+Benchmarks for the PFVS hot paths, run against the simulated Triad board.
+
+Covers the driver calls (with their bus transaction counts), single and batched prediction,
+a full filament scan and the per-line cost of the serial hooks (process_gcode and
+process_temperatures). Results are written as JSON so runs from different commits can be
+compared:
+
+    python benchmarks/bench_pfvs.py --output before.json
+    python benchmarks/bench_pfvs.py --output after.json --compare before.json
+
+The script exits with status 1 if a serial hook costs more than --line-budget-us per line, and
+with --compare also if any benchmark got slower than --threshold or needs more bus transactions
+than before. Timings are compared on the median.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("PFVS_BACKEND", "simulator")
+
+import numpy as np
+
+from octoprint_pfvs import spectrometer as spect
+from octoprint_pfvs.predict_material import predict_material, predict_materials
+from octoprint_pfvs.simulator import DEFAULT_SPECTRUM, SimulatedTriad
+
+
+def measure(fn, repeat, warmup=1):
+    """Runs fn repeat times and returns timing statistics plus the bus transactions per call."""
+    for _ in range(warmup):
+        fn()
+    spect.getBusStats(reset=True)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    bus = spect.getBusStats(reset=True)
+    timings.sort()
+    return {
+        "repeat": repeat,
+        "mean_s": statistics.fmean(timings),
+        "p50_s": timings[len(timings) // 2],
+        "p95_s": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        "ops_per_s": repeat / sum(timings) if sum(timings) else float("inf"),
+        "bus_transactions_per_call": bus["transactions"] / repeat,
+    }
+
+
+class SleepRecorder:
+    """Replaces time.sleep so scans report their active time and requested sleeps separately."""
+    def __init__(self):
+        self.slept = 0.0
+        self._sleep = time.sleep
+
+    def __enter__(self):
+        time.sleep = self._record
+        return self
+
+    def __exit__(self, *exc):
+        time.sleep = self._sleep
+
+    def _record(self, seconds):
+        self.slept += seconds
+
+
+class _Logger:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class _PluginManager:
+    def send_plugin_message(self, identifier, data):
+        pass
+
+
+class _Printer:
+    def cancel_print(self):
+        pass
+
+    def commands(self, commands, force=False):
+        pass
+
+
+class _Settings:
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, path, **kwargs):
+        return self.values.get(path[0])
+
+    def get_float(self, path, **kwargs):
+        return float(self.values.get(path[0]))
+
+    def get_int(self, path, **kwargs):
+        return int(self.values.get(path[0]))
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self.values.get(path[0]))
+
+
+def make_plugin():
+    from octoprint_pfvs import PFVSPlugin
+
+    plugin = PFVSPlugin()
+    plugin._logger = _Logger()
+    plugin._plugin_manager = _PluginManager()
+    plugin._printer = _Printer()
+    plugin._identifier = "pfvs"
+    plugin._settings = _Settings(plugin.get_settings_defaults())
+    # The simulated board is already set up by main, so skip the init thread's hardware bring-up
+    plugin.load_pipeline()
+    plugin.readiness.set_ready()
+    return plugin
+
+
+def bench_driver(args, results):
+    results["driver.setGain"] = measure(lambda: spect.setGain(3), args.repeat)
+    results["driver.setIntegrationTime"] = measure(lambda: spect.setIntegrationTime(63), args.repeat)
+
+    toggle = {"state": False}
+
+    def toggle_leds():
+        toggle["state"] = not toggle["state"]
+        spect.shutterLEDs(toggle["state"])
+
+    results["driver.shutterLEDs_toggle"] = measure(toggle_leds, args.repeat)
+    results["driver.readRAW"] = measure(spect.readRAW, args.repeat)
+    results["driver.readCAL"] = measure(spect.readCAL, args.repeat)
+
+
+def bench_prediction(args, results):
+    rng = np.random.default_rng(0)
+    spectra = np.abs(np.asarray(DEFAULT_SPECTRUM) * rng.normal(1, 0.3, (args.batch, 18)))
+    colors = rng.choice(["B", "G", "K", "R", "W"], args.batch)
+
+    results["predict.single"] = measure(lambda: predict_material(spectra[0], "R"), args.repeat * 10)
+    batch = measure(lambda: predict_materials(spectra, colors), max(1, args.repeat // 10))
+    batch["samples_per_s"] = batch["ops_per_s"] * args.batch
+    results[f"predict.batch_{args.batch}"] = batch
+
+
+def bench_scan(args, results):
+    plugin = make_plugin()
+    with SleepRecorder() as sleeps:
+        scan = measure(plugin.filament_scan, args.scan_repeat)
+    scan["requested_sleep_per_call_s"] = sleeps.slept / (args.scan_repeat + 1)
+    results["scan.filament_scan_active"] = scan
+
+
+def bench_gcode(args, results):
+    plugin = make_plugin()
+    lines = [
+        "ok",
+        "ok T:25.1 /0.0 B:24.9 /0.0 T0:25.1 /0.0 @:0 B@:0",
+        "echo:busy: processing",
+        "T:170.0/170.0 B:60.0/60.0",
+        "ok N123 P15 B3",
+    ]
+    stream = lines * (args.lines // len(lines))
+    # What OctoPrint parses out of the temperature lines, heating up to the 170° preheat
+    reports = [{"T0": (25.0 + i % 145, 170.0), "B": (24.0 + i % 36, 60.0)} for i in range(len(stream))]
+
+    def feed():
+        for line in stream:
+            plugin.process_gcode(None, line)
+
+    def feed_temperatures():
+        for report in reports:
+            plugin.process_temperatures(None, report)
+
+    for name, starting in (("idle", False), ("print_start", True)):
+        plugin.print_starting = starting
+        for hook, fn in (("process_gcode", feed), ("process_temperatures", feed_temperatures)):
+            result = measure(fn, max(1, args.repeat // 10))
+            result["lines_per_s"] = result["ops_per_s"] * len(stream)
+            result["per_line_us"] = result["p50_s"] / len(stream) * 1e6
+            results[f"gcode.{hook}_{name}"] = result
+    plugin.print_starting = False
+    plugin.on_shutdown()
+
+
+def check_line_budget(results, budget_us):
+    """Names of the received-line hooks whose median per-line cost is above ``budget_us``."""
+    over = []
+    for name, result in sorted(results.items()):
+        if name.startswith("gcode.") and result["per_line_us"] > budget_us:
+            print(f"{name}: {result['per_line_us']:.2f} us per line, budget {budget_us:.2f} us")
+            over.append(name)
+    return over
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before, after = baseline[name]["p50_s"], result["p50_s"]
+        change = (after - before) / before if before else 0.0
+        # Bus traffic against the simulator is deterministic, so any increase counts
+        bus_before = baseline[name].get("bus_transactions_per_call", 0)
+        bus_after = result.get("bus_transactions_per_call", 0)
+        flag = "REGRESSION" if change > threshold or bus_after > bus_before else ""
+        print(f"{name:40s} {before * 1e3:10.3f} ms -> {after * 1e3:10.3f} ms {change:+7.1%} "
+              f"bus {bus_before:7.1f} -> {bus_after:7.1f} {flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", help="baseline JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown counted as a regression")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--scan-repeat", type=int, default=5)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--lines", type=int, default=10000)
+    parser.add_argument("--line-budget-us", type=float, default=5.0,
+                        help="per-line cost of the serial hooks above which the run fails")
+    parser.add_argument("--latency-polls", type=int, default=2, help="simulated slave latency in status polls")
+    parser.add_argument("--only", nargs="*", choices=["driver", "predict", "scan", "gcode"])
+    args = parser.parse_args(argv)
+
+    logging.getLogger("octoprint.plugins.pfvs").disabled = True
+    spect.setBackend(SimulatedTriad(time_scale=0, latency_polls=args.latency_polls, seed=0))
+
+    results = {}
+    suites = {"driver": bench_driver, "predict": bench_prediction, "scan": bench_scan, "gcode": bench_gcode}
+    for name, suite in suites.items():
+        if not args.only or name in args.only:
+            suite(args, results)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "latency_polls": args.latency_polls,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    failed = bool(check_line_budget(results, args.line_budget_us))
+    if args.compare:
+        failed = bool(compare(results, args.compare, args.threshold)) or failed
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
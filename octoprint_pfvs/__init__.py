@@ -7,18 +7,78 @@ import re
 import sys
 import os
 import math
-import numpy as np
-from flask import jsonify
-import RPi.GPIO as GPIO
-from octoprint_pfvs import spectrometer as spect
+import functools
+import tempfile
+from flask import Response, jsonify, request
+from octoprint.util import RepeatedTimer
+from octoprint_pfvs import hardware
 from octoprint_pfvs.filament_gcodes import FILAMENTS
-from octoprint_pfvs.predict_material import predict_material
+from octoprint_pfvs.arbiter import PRIORITY_LIVE, PRIORITY_MAINTENANCE, SpectrometerArbiter
+from octoprint_pfvs.presence import PresenceMonitor
+from octoprint_pfvs.metrics import get_metrics
+from octoprint_pfvs.tracing import traced, tracer
+from octoprint_pfvs.startup import FAILED, LazyModule, Readiness
+
+# NumPy, the driver and the classifier are loaded by the init thread, not while OctoPrint boots
+np = LazyModule("numpy")
+spect = LazyModule("octoprint_pfvs.spectrometer")
+acquisition = LazyModule("octoprint_pfvs.acquisition")
+exposures = LazyModule("octoprint_pfvs.exposure")
+prediction = LazyModule("octoprint_pfvs.predict_material")
+model_registry = LazyModule("octoprint_pfvs.model_registry")
+model_bundle = LazyModule("octoprint_pfvs.model_bundle")
+streaming = LazyModule("octoprint_pfvs.streaming")
+pipeline = LazyModule("octoprint_pfvs.pipeline")
+scan_history = LazyModule("octoprint_pfvs.history")
+PIPELINE_MODULES = (np, spect, acquisition, exposures, prediction, model_registry, model_bundle, streaming,
+                    pipeline, scan_history)
+
+FILAMENT_COMMAND = re.compile(r"M70([12])(?!\d)")  # M701 load / M702 unload
+METRICS_SNAPSHOT_FILE = "metrics.jsonl"
+
+metrics = get_metrics()
+MATERIAL_CHECKS = metrics.counter("pfvs_material_checks_total", "Material checks at the final print temperature", ["material"])
+PRINT_CANCELLATIONS = metrics.counter("pfvs_print_cancellations_total", "Prints cancelled for an unsupported material", ["material"])
+TEMPERATURE_CORRECTIONS = metrics.counter("pfvs_temperature_corrections_total", "Target temperatures corrected for the detected material", ["material"])
+SCANS = metrics.counter("pfvs_scans_total", "Finished verification scans by predicted material", ["mode", "material"])
+SCAN_FAILURES = metrics.counter("pfvs_scan_failures_total", "Verification scans that raised an error", ["mode"])
+SCAN_SECONDS = metrics.histogram("pfvs_scan_duration_seconds", "Verification scan duration", ["mode"])
+SCAN_FRAMES = metrics.histogram("pfvs_scan_frames", "Light frames per verification scan", ["mode"], buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24))
+I2C_COUNTERS = {
+    key: metrics.counter(f"pfvs_i2c_{name}_total", help) for key, name, help in (
+        ("transactions", "transactions", "I2C bus transactions"),
+        ("statusPolls", "status_polls", "Reads of the slave status register"),
+        ("registerReads", "register_reads", "Virtual register reads"),
+        ("registerWrites", "register_writes", "Virtual register writes"),
+        ("skippedWrites", "skipped_writes", "Register writes skipped because the shadow copy matched"),
+        ("skippedDevsel", "skipped_devsel", "DEVSEL writes skipped because the device was already selected"),
+    )
+}
+I2C_TIMEOUTS = metrics.counter("pfvs_i2c_timeouts_total", "Waits on the spectrometer that timed out", ["what"])
+MEASUREMENTS = metrics.counter("pfvs_measurements_total", "Spectrometer conversions waited for")
+LIVE_FRAMES = metrics.counter("pfvs_live_frames_total", "Live stream frames by what became of them", ["outcome"])
+LIVE_FRAME_RATE = metrics.gauge("pfvs_live_frame_rate", "Measured live stream acquisition rate, frames per second")
+
+
+def collect_driver_metrics():
+    """Mirrors the driver's own counters into the metrics registry."""
+    bus = spect.getBusStats()
+    for key, counter in I2C_COUNTERS.items():
+        counter.set_total(bus[key])
+    measure = spect.getMeasureStats()
+    I2C_TIMEOUTS.set_total(spect.getPollStats()["timeouts"], what="status")
+    I2C_TIMEOUTS.set_total(measure["timeouts"], what="data_ready")
+    MEASUREMENTS.set_total(measure["measurements"])
+
+
+FILAMENT_SENSOR_PIN = 11  # IR filament sensor, physical pin number, reads LOW when filament is present
 
 class PFVSPlugin(octoprint.plugin.SettingsPlugin,
                  octoprint.plugin.AssetPlugin,
                  octoprint.plugin.TemplatePlugin,
                  octoprint.plugin.EventHandlerPlugin,
                  octoprint.plugin.BlueprintPlugin,
+                 octoprint.plugin.ShutdownPlugin,
                  octoprint.plugin.OctoPrintPlugin):
 
     def __init__(self):
@@ -29,27 +89,151 @@ class PFVSPlugin(octoprint.plugin.SettingsPlugin,
         self.print_starting = False
         self.spectrometer_thread = None
         self.spectrometer_running = False 
+        self.live_pipeline = None
+        self.live_stopped = None  # Stop token of the current live stream, each start gets a new one
+        self.live_lock = threading.Lock()
+        self.live_conversion = None
+        self.live_ready_at = 0.0
         self.waiting_for_final_temp = True
         self.last_temp_change_time = 0
         self.predicted_material = ""
-        self.count_pla = 0
-        self.count_asa = 0
-        self.count_petg = 0
-        self.count_settings = 0
-        self.count_stops = 0
+        self.last_temps = None
+        self.gpio = None
+        self.presence = None
+        self.arbiter = SpectrometerArbiter(self.verification_scan)
+        self.readiness = Readiness()
+        self.init_thread = None
+        self.dark_cache = None
+        self.dark_refresh_timer = None
+        self.dark_refresh_interval = 0.0
+        self.frame_stack = None
+        self.last_spectrum = None
+        self.last_variance = None
+        self.prediction_confidence = None
+        self.spool_id = 0
+        self.print_count = 0
+        self.material_check_lock = threading.Lock()
+        self.material_checked = None  # (print_count, spool_id) the material checks already acted on
+        self.exposure_cache = None
+        self.history = None
+        self.metrics_timer = None
+
+    def on_shutdown(self):
+        if self.presence is not None:
+            self.presence.stop()
+        if self.dark_refresh_timer is not None:
+            self.dark_refresh_timer.cancel()
+        if self.metrics_timer is not None:
+            self.metrics_timer.cancel()
+            self.write_metrics_snapshot()
+        self.arbiter.shutdown()
+        if self.history is not None:
+            self.history.close()
 
     def on_after_startup(self):
-        self._logger.info("PFVS Plugin initialized.")
+        tracer.configure(enabled=self._settings.get_boolean(["tracing_enabled"]),
+                         capacity=self._settings.get_int(["trace_buffer"]))
+
+        interval = self._settings.get_float(["metrics_snapshot_interval"])
+        if interval > 0:
+            self.metrics_timer = RepeatedTimer(interval, self.write_metrics_snapshot, daemon=True)
+            self.metrics_timer.start()
+
+        # Loading the pipeline and the 3 s factory reset of the spectrometer happen off the startup path
+        self.init_thread = threading.Thread(target=self.initialize, name="pfvs-init", daemon=True)
+        self.init_thread.start()
+
+    def initialize(self):
+        """Runs on the init thread: loads the pipeline, brings up the hardware and warms up the classifier."""
         try:
-            spect.init()
-            self._logger.info("Spectrometer initialized successfully.")
+            with self.readiness.step("imports"):
+                self.load_pipeline()
+                metrics.add_collector(collect_driver_metrics)
+
+            with self.readiness.step("spectrometer"):
+                backend = self._settings.get(["backend"])
+                spect.setBackend(hardware.create_bus_backend(spect.I2C_ADDR, backend))
+                self.gpio = hardware.create_gpio_backend(backend)
+                self._logger.info(f"Using {hardware.backend_name(backend)} backend.")
+                spect.init()
+                self._logger.info("Spectrometer initialized successfully.")
+
+            try:
+                self.start_presence_monitor()
+            except Exception as e:
+                self._logger.error(f"Failed to start the filament presence monitor: {e}")
+
+            with self.readiness.step("model"):
+                # Bundles installed through the API live in the data folder and survive plugin updates
+                registry = model_registry.get_registry()
+                registry.install_dir = self.get_plugin_data_folder()
+                registry.warm_up()
+
+            if self._settings.get_boolean(["history_enabled"]):
+                try:
+                    self.history = scan_history.ScanHistory(self.get_plugin_data_folder(), logger=self._logger)
+                except Exception as e:
+                    self._logger.error(f"Failed to open scan history: {e}")
+
+            interval = self.dark_refresh_interval = self._settings.get_float(["dark_refresh_interval"])
+            if interval > 0:
+                self.dark_refresh_timer = RepeatedTimer(interval, self.refresh_dark_frame_if_idle, daemon=True)
+                self.dark_refresh_timer.start()
         except Exception as e:
-            self._logger.error(f"Failed to initialize spectrometer: {e}")
+            self.readiness.set_failed(e)  # Keeps the reason of a failed step
+            self._logger.error(f"PFVS Plugin failed to initialize: {self.readiness.reason}")
+            return
+
+        self.readiness.set_ready()
+        self._logger.info(f"PFVS Plugin initialized: {self.readiness.snapshot()}")
+
+    def load_pipeline(self):
+        """Imports NumPy, the driver and the classifier code and creates the caches that need them."""
+        for module in PIPELINE_MODULES:
+            module.load()
+        self.dark_cache = acquisition.DarkFrameCache(
+            max_age=self._settings.get_float(["dark_max_age"]),
+            max_temp_drift=self._settings.get_float(["dark_max_temp_drift"]),
+        )
+        self.exposure_cache = exposures.ExposureCache()
 
     ##~~ SettingsPlugin mixin
 
     def get_settings_defaults(self):
-        return {}
+        return {
+            "backend": hardware.HARDWARE,  # "hardware" or "simulator", PFVS_BACKEND overrides it
+            "init_wait_timeout": 60.0,  # seconds a scan requested during startup waits for the plugin to be ready
+            "presence_debounce": 0.05,  # seconds the filament sensor must hold its level before it counts
+            "scan_on_insert": True,  # scan as soon as filament is inserted instead of waiting for M701 or print start
+            "scan_reuse_window": 2.0,  # seconds a finished scan answers new scan requests for the same spool
+            "dark_max_age": 300.0,  # seconds before a cached dark frame is retaken
+            "dark_max_temp_drift": 2.0,  # sensor temperature change (°C) that invalidates a dark frame
+            "dark_refresh_interval": 60.0,  # seconds between idle checks of the dark frame, 0 disables them
+            "scan_frames": 3,  # light frames averaged per verification scan
+            "frame_combine": "mean",  # "mean", "median" or "sigma_clip"
+            "scan_mode": "sequential",  # "sequential" stops once confident, "fixed" always takes scan_frames
+            "scan_confidence": 1.0,  # SVM margin a sequential scan needs before it stops
+            "scan_stable_frames": 2,  # consecutive identical predictions a sequential scan needs
+            "scan_max_frames": 12,
+            "scan_time_budget": 4.0,  # seconds of light frames a sequential scan may take
+            "auto_exposure": True,  # pick gain and integration time per spool instead of always using gain 3 / 63
+            "exposure_target_low": 0.004,  # band (fraction of full scale) the brightest RAW channel should land in
+            "exposure_target_high": 0.012,  # training spectra peak around 800 counts (0.012) at gain 3 / 63
+            "exposure_max_gain": 3,  # longest exposure auto exposure may use
+            "exposure_max_integration_time": 63,
+            "history_enabled": True,  # record every verification scan in the plugin's data folder
+            "metrics_snapshot_interval": 300.0,  # seconds between metrics snapshots in the data folder, 0 disables them
+            "tracing_enabled": False,  # record per-stage timings of scans, readable at /traces
+            "trace_buffer": 50,  # number of recent traces kept
+            "live_frame_rate": 4.0,  # live frames acquired per second, 0 for as fast as the hardware allows
+            "live_buffer": 8,  # frames buffered between acquisition and inference
+            "live_batch": 8,  # most frames classified in one batch
+            "live_overflow": "merge",  # when inference falls behind, "merge" frames into the newest one or "drop" the oldest
+            "stream_max_rate": 2.0,  # pushes per second to the web interface, frames in between are averaged
+            "stream_encoding": "q16",  # "json", "q16" (16-bit quantized, base64) or "f32" (float32, base64)
+            "stream_min_change": 0.01,  # relative change below which an unchanged prediction is not pushed again
+            "stream_keepalive": 5.0,  # seconds after which a push goes out even if nothing changed
+        }
 
     ##~~ AssetPlugin mixin
 
@@ -91,6 +275,7 @@ class PFVSPlugin(octoprint.plugin.SettingsPlugin,
             if new_state == "STARTING":
                 self._logger.info("Print is officially starting.")
                 self.print_starting = True
+                self.print_count += 1
                 
             else:
                 self.print_start = False
@@ -105,139 +290,358 @@ class PFVSPlugin(octoprint.plugin.SettingsPlugin,
     ##~~ G-code received hook
 
     def process_gcode(self, comm, line, *args, **kwargs):
-        """ Processes received G-code and handles filament verification & temperature adjustments """
+        """ Watches received lines for filament load/unload, temperatures come in through process_temperatures """
 
-        if "M701" in line:  # Filament load command detected
+        if "M70" not in line:  # Cheap pre-filter, nearly every line ends here
+            if self.is_filament_loading or self.is_filament_unloading:
+                self.is_filament_loading = False
+                self.is_filament_unloading = False
+            return line
+
+        match = FILAMENT_COMMAND.search(line)
+        if match is None:
+            self.is_filament_loading = False
+            self.is_filament_unloading = False
+
+        elif match.group(1) == "1":  # Filament load command detected
             self.is_filament_loading = True
             self.is_filament_unloading = False
-            self._logger.info("Filament is being loaded.") # Check if filament is present
-            self.filament_scan()
-            self.filament_scan()
-            self._logger.info("Filament is loaded and scan happened")
-            self._logger.info(f"Predicted material: {self.predicted_material}") 
-            self._plugin_manager.send_plugin_message(
-                self._identifier, 
-                {"predicted_material": self.predicted_material}
-            )
+            if self.presence is not None and self.presence.present and self.predicted_material:
+                # The presence monitor already scanned this spool when it was inserted
+                self._logger.info(f"Filament is being loaded, scanned on insert as {self.predicted_material}.")
+            elif self.presence is not None and self.presence.present:
+                # The insert already started this spool, join its scan (or queue one if scan_on_insert is off)
+                self._logger.info("Filament is being loaded.")
+                self.request_scan("M701")
+            else:
+                self._logger.info("Filament is being loaded.")
+                self.new_spool()
+                self.request_scan("M701")
 
-        elif "M702" in line:  # Filament unload command detected
+        else:  # Filament unload command detected
             self.is_filament_loading = False
             self.is_filament_unloading = True
-            self.predicted_material == ""
+            self.predicted_material = ""
             self._logger.info("Filament is being unloaded.")
+            self.new_spool()
 
-        else:
-            self.is_filament_loading = False
-            self.is_filament_unloading = False
-            
-        if self.print_starting:     
-            match = re.search(r'(\d+\.?\d*)/(\d+\.?\d*)', line)
-            if not match:
-                return line  # Skip if no match
+        return line
+
+    ##~~ Temperatures received hook
+
+    def process_temperatures(self, comm, parsed_temperatures, *args, **kwargs):
+        """ Handles filament verification & temperature adjustments once the hotend heads for its final temperature """
+
+        if not self.print_starting:
+            return parsed_temperatures
+
+        hotend = parsed_temperatures.get("T0") or parsed_temperatures.get("T")
+        if hotend is None or hotend[0] is None or hotend[1] is None:
+            return parsed_temperatures
+
+        current_temp, target_temp = hotend
+        self.last_temps = (current_temp, target_temp)
+
+        if target_temp != 170.0 and target_temp != 0.0:  # This means it switched to the final temp
+            if (self.predicted_material == ""):
+                self.request_scan("print start")
+            if not self.arbiter.busy:  # Otherwise the scan result applies the checks once it's in
+                self.check_material(current_temp, target_temp)
+
+        return parsed_temperatures
+
+    def check_material(self, current_temp, target_temp):
+        """
+        Cancels the print or corrects the temperatures once the final target temperature is reached.
+
+        Both the temperature hook and a finishing scan call this, so it acts at most once per print
+        and spool: whichever caller sees the prediction first runs the checks.
+        """
+        if target_temp * 0.99 > current_temp:
+            return
+        with self.material_check_lock:
+            checked = (self.print_count, self.spool_id)
+            if self.predicted_material and self.material_checked == checked:
+                return
+            if self.predicted_material:
+                self.material_checked = checked
+
+            MATERIAL_CHECKS.inc(material=self.predicted_material or "none")
+            if self.predicted_material == "ASA":
+                PRINT_CANCELLATIONS.inc(material="ASA")
+                self._logger.info(f"Cannot print ASA on Prusa Mini")
+                self._printer.cancel_print()
+                return
             
-            current_temp = float(match.group(1))
-            target_temp = float(match.group(2))
-
-            if target_temp != 170.0 and target_temp != 0.0:  # This means it switched to the final temp
-                if (self.predicted_material == ""):
-                        self.filament_scan()
-                        self.filament_scan()
-                        self._logger.info(f"Predicted material: {self.predicted_material}")  
-                        self._plugin_manager.send_plugin_message(
-                            self._identifier, 
-                            {"predicted_material": self.predicted_material}
-                        )
-                if target_temp * 0.99 <= current_temp:
-                    if self.predicted_material == "ASA":
-                        self.count_asa += 1
-                        self.count_stops += 1
-                        self._logger.info(f"Cannot print ASA on Prusa Mini")
-                        self._printer.cancel_print()
-                        return line
-                    
-                    if self.predicted_material == "PET":
-                        self.count_petg += 1
-                        self.count_stops += 1
-                        self._logger.info(f"Cannot print PETG on Prusa Mini")
-                        self._printer.cancel_print()
-                        return line
-
-                    # Adjust settings if the detected filament doesn't match target temp
-                    if self.predicted_material in FILAMENTS and self.predicted_material == "PLA":
-                        self.count_pla += 1
-                        filament = FILAMENTS[self.predicted_material]
-                        if (self.last_temp_change_time == 0):
-                            if not math.isclose(target_temp, filament.print_temp, rel_tol=1e-2):  
-                                self._logger.info(f"Incorrect target temperature detected: {target_temp}°C. Changing to {filament.print_temp}°C.")
-                                self.count_settings += 1
-                                gcode_commands = filament.generate_gcode()
-                                self._printer.commands(gcode_commands, force=True)
-                                self._logger.info(f"Sent updated G-code commands: {gcode_commands}")
-                                self.last_temp_change_time = 1
-                    else:
-                        self._logger.warning(f"Unknown filament type: {self.predicted_material}. No preset settings found.") 
+            if self.predicted_material == "PET":
+                PRINT_CANCELLATIONS.inc(material="PET")
+                self._logger.info(f"Cannot print PETG on Prusa Mini")
+                self._printer.cancel_print()
+                return
+
+            # Adjust settings if the detected filament doesn't match target temp
+            if self.predicted_material in FILAMENTS and self.predicted_material == "PLA":
+                filament = FILAMENTS[self.predicted_material]
+                if (self.last_temp_change_time == 0):
+                    if not math.isclose(target_temp, filament.print_temp, rel_tol=1e-2):  
+                        self._logger.info(f"Incorrect target temperature detected: {target_temp}°C. Changing to {filament.print_temp}°C.")
+                        TEMPERATURE_CORRECTIONS.inc(material=self.predicted_material)
+                        gcode_commands = filament.generate_gcode()
+                        self._printer.commands(gcode_commands, force=True)
+                        self._logger.info(f"Sent updated G-code commands: {gcode_commands}")
+                        self.last_temp_change_time = 1
+            else:
+                self._logger.warning(f"Unknown filament type: {self.predicted_material}. No preset settings found.") 
+
+    ##~~ Asynchronous filament scans
+
+    def request_scan(self, reason):
+        """
+        Queues a verification scan on the arbiter and returns its future without blocking, or None
+        if the plugin failed to initialize. Scans requested while it is still initializing wait
+        for it on the arbiter thread. Requests while a scan is queued or running, or shortly
+        after one finished, share that scan.
+        """
+        if self.readiness.state == FAILED:
+            self._logger.debug(f"Not scanning for {reason}, plugin {self.readiness.state}: {self.readiness.reason}")
+            return None
+        return self.arbiter.submit(reason, callback=self.on_scan_done,
+                                   reuse_within=self._settings.get_float(["scan_reuse_window"]))
+
+    @traced(root=True)
+    def verification_scan(self):
+        """Runs on the arbiter thread."""
+        if not self.readiness.wait(self._settings.get_float(["init_wait_timeout"])):
+            raise RuntimeError(f"Plugin is not ready ({self.readiness.state}): {self.readiness.reason}")
+        while True:
+            spool_id = self.spool_id
+            if self._settings.get(["scan_mode"]) == "sequential":
+                self.sequential_filament_scan()
             else:
-                return line                
-        self.waiting_for_final_temp = True    
+                self.filament_scan()
+            if self.spool_id == spool_id:
+                return self.predicted_material
+
+            # The filament was swapped mid-scan, the result describes neither spool
+            self.predicted_material = ""
+            if not self.is_filament_detected():
+                return self.predicted_material
+            self._logger.info("Filament changed during the scan, scanning the new one")
+
+    def on_scan_done(self, future):
+        """Publishes a finished scan and runs the material checks that were waiting on it."""
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self._logger.error(f"Filament scan #{future.ticket} failed: {future.exception()}")
+            return
 
-        return line
+        self._logger.info(f"Predicted material: {self.predicted_material}")
+        self._plugin_manager.send_plugin_message(
+            self._identifier, 
+            {"predicted_material": self.predicted_material, "confidence": self.prediction_confidence,
+             "scan_ticket": future.ticket}
+        )
 
+        if self.print_starting and self.last_temps is not None:
+            current_temp, target_temp = self.last_temps
+            if target_temp != 170.0 and target_temp != 0.0:
+                self.check_material(current_temp, target_temp)
 
     ##~~ Spectrometer Handling
+    def start_presence_monitor(self):
+        self.presence = PresenceMonitor(
+            self.gpio, FILAMENT_SENSOR_PIN,
+            on_insert=self.on_filament_inserted, on_remove=self.on_filament_removed,
+            debounce=self._settings.get_float(["presence_debounce"]), logger=self._logger,
+        )
+        self.presence.start()
+        self._logger.info(f"Filament presence monitor started: {self.presence.stats()}")
+
+    def on_filament_inserted(self):
+        """Presence monitor callback: a new spool, scanned right away unless disabled."""
+        self.new_spool()
+        self.predicted_material = ""
+        self.prediction_confidence = None
+        self.fire_presence_event("filament_inserted")
+        if self._settings.get_boolean(["scan_on_insert"]):
+            self.request_scan("filament inserted")
+
+    def on_filament_removed(self):
+        """Presence monitor callback: whatever was predicted no longer describes the filament."""
+        self.new_spool()
+        self.predicted_material = ""
+        self.prediction_confidence = None
+        self.fire_presence_event("filament_removed")
+
+    def fire_presence_event(self, event):
+        self._event_bus.fire(f"plugin_{self._identifier}_{event}", {"spool_id": self.spool_id})
+        self._plugin_manager.send_plugin_message(
+            self._identifier, {"filament_present": event == "filament_inserted", "predicted_material": ""}
+        )
+
     def is_filament_detected(self):
         """Returns True if the IR sensor detects filament."""
-        GPIO.setwarnings(False)
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(11, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        return GPIO.input(11) == GPIO.LOW
+        if self.presence is not None:
+            return self.presence.present
+        if self.gpio is None:
+            self.gpio = hardware.create_gpio_backend(self._settings.get(["backend"]))
+        return not self.gpio.read(FILAMENT_SENSOR_PIN)
     
     
-    def log_filament_data(self):
-        """Logs filament verification data to a file."""
+    @traced()
+    def record_scan(self, dark, light, exposure, frames, mode):
+        """Queues a finished scan for the history, the write happens on the history's own thread."""
+        if self.history is None:
+            return
         try:
-            log_file = os.path.join(self.get_plugin_data_folder(), "statistics_log.txt")
-            with open(log_file, "a") as f:
-                f.write(f"Times Predicted PLA: {self.count_pla}\n")
-                f.write(f"Times Predicted ASA: {self.count_asa}\n")
-                f.write(f"Times Predicted PETG: {self.count_petg}\n")
-                f.write(f"Times Settings Changed: {self.count_settings}\n")
-                f.write(f"Number of Print Stopped: {self.count_stops}\n")
-                f.write("-" * 40 + "\n")
-            self._logger.info("Filament data logged successfully.")
+            job = self._printer.get_current_job() or {}
+            self.history.append(
+                dark.values, light, exposure.gain, exposure.integration_time, frames,
+                self.predicted_material, confidence=self.prediction_confidence if mode == "sequential" else None,
+                job=(job.get("file") or {}).get("name"), mode=mode,
+                target_temp=self.last_temps[1] if self.last_temps is not None else None,
+            )
         except Exception as e:
-            self._logger.error(f"Error writing to file: {e}")
+            self._logger.error(f"Error recording scan: {e}")
 
+    def count_scan(self, mode, frames, duration):
+        SCANS.inc(mode=mode, material=self.predicted_material)
+        SCAN_FRAMES.observe(frames, mode=mode)
+        SCAN_SECONDS.observe(duration, mode=mode)
+
+    def write_metrics_snapshot(self):
+        """Timer callback: appends the current metrics to metrics.jsonl in the data folder."""
+        try:
+            metrics.write_snapshot(os.path.join(self.get_plugin_data_folder(), METRICS_SNAPSHOT_FILE))
+        except Exception as e:
+            self._logger.error(f"Error writing metrics snapshot: {e}")
+
+    def new_spool(self):
+        """Filament was loaded or unloaded, so the next scan must not reuse the last spool's exposure."""
+        if self.exposure_cache is not None:
+            self.exposure_cache.invalidate(self.spool_id)
+        self.arbiter.expire()
+        self.spool_id += 1
+
+    @traced()
+    def scan_exposure(self):
+        """Returns the exposure for the loaded spool, searching for one on its first scan."""
+        if not self._settings.get_boolean(["auto_exposure"]):
+            return exposures.REFERENCE_EXPOSURE
+
+        exposure = self.exposure_cache.get(self.spool_id)
+        if exposure is None:
+            spool_id = self.spool_id
+            spect.shutterLEDs(True)
+            result = exposures.auto_expose(
+                target_low=self._settings.get_float(["exposure_target_low"]),
+                target_high=self._settings.get_float(["exposure_target_high"]),
+                max_exposure=exposures.Exposure(self._settings.get_int(["exposure_max_gain"]),
+                                                self._settings.get_int(["exposure_max_integration_time"])),
+            )
+            self._logger.info(f"Auto exposure for spool {spool_id}: {result}")
+            exposure = result.exposure
+            self.exposure_cache.put(spool_id, exposure)
+        return exposure
+
+    def check_clipping(self, exposure):
+        """Drops the cached exposure if a frame clipped, the next scan of this spool searches again."""
+        if exposure is not exposures.REFERENCE_EXPOSURE and self.frame_stack.frames.max() >= exposures.FULL_SCALE:
+            self._logger.warning(f"Frames clipped at {exposure}, auto exposure will run again")
+            self.exposure_cache.invalidate(self.spool_id)
+
+    @traced()
+    def dark_reference(self, exposure=None):
+        """Returns the dark frame for the scan settings, only re-acquiring it when the cached one is stale."""
+        exposure = exposure or exposures.REFERENCE_EXPOSURE
+        dark, _ = acquisition.get_dark_frame(self.dark_cache, exposure.gain, exposure.integration_time)
+        return dark
+
+    def refresh_dark_frame_if_idle(self):
+        """Timer callback: queues a dark frame refresh while the printer and the spectrometer are idle."""
+        if self.spectrometer_running or not self.arbiter.idle or self._printer.is_printing():
+            return
+        self.arbiter.submit("dark refresh", fn=self.refresh_dark_frame, priority=PRIORITY_MAINTENANCE)
+
+    @traced(root=True)
+    def refresh_dark_frame(self):
+        """Re-acquires the dark frame if it is stale or will expire before the next idle check."""
+        exposure = self.exposure_cache.peek(self.spool_id) or exposures.REFERENCE_EXPOSURE
+        exposure.apply()
+        temperatures = spect.temperatures()
+        margin = self.dark_refresh_interval
+        if self.dark_cache.needs_refresh(exposure.gain, exposure.integration_time, temperatures, margin=margin):
+            acquisition.acquire_dark_frame(exposure.gain, exposure.integration_time, self.dark_cache, temperatures)
+            return "refreshed"
+        return "fresh"
+
+    @traced(root=True)
     def filament_scan(self):
         try:
-            spect.setGain(3)
-            spect.setIntegrationTime(63)
-            spect.shutterLED("AS72651", False)
-            spect.shutterLED("AS72652", False)
-            spect.shutterLED("AS72653", False)
-            time.sleep(0.18)
-            dark_spect_data = spect.readRAW()
-            time.sleep(1.0)  
-
-            spect.shutterLED("AS72651", True)
-            spect.shutterLED("AS72652", True)
-            spect.shutterLED("AS72653", True)
-            # Reading spectrometer data
-            time.sleep(0.18)
-            light_spect_data = spect.readRAW()
-            time.sleep(0.18)
-            light_spect_data = spect.readRAW()
-            time.sleep(0.18)
-            light_spect_data = spect.readRAW()
-             
-
-            for i in range(len(light_spect_data)):
-                    light_spect_data[i] = light_spect_data[i] - dark_spect_data[i]
-                
-            self.predicted_material = predict_material(light_spect_data, 'R')
-            time.sleep(1)  # Adjust sampling rate
+            start = time.monotonic()
+            exposure = self.scan_exposure()
+            exposure.apply()
+            dark = self.dark_reference(exposure)
+
+            spect.shutterLEDs(True)
+            # Reading spectrometer data, every frame goes into the average
+            self.frame_stack = acquisition.acquire_frames(self._settings.get_int(["scan_frames"]), self.frame_stack)
+            self.check_clipping(exposure)
+            light, variance = self.frame_stack.combine(self._settings.get(["frame_combine"]))
+
+            light_spect_data = exposures.normalize(light - dark.values, exposure)
+            self.last_spectrum = light_spect_data
+            self.last_variance = variance
+            materials, confidences = prediction.predict_with_confidence(light_spect_data.reshape(1, -1), 'R')
+            self.prediction_confidence = float(confidences[0])
+            self.predicted_material = materials[0]
+            self.record_scan(dark, light, exposure, self.frame_stack.count, "fixed")
+            self.count_scan("fixed", self.frame_stack.count, time.monotonic() - start)
         except Exception as e:
+            SCAN_FAILURES.inc(mode="fixed")
             self._logger.error(f"Error reading spectrometer data: {e}")
             
+    @traced(root=True)
+    def sequential_filament_scan(self):
+        """Takes light frames only until the prediction is stable and confident, within a time budget."""
+        try:
+            start = time.monotonic()
+            exposure = self.scan_exposure()
+            exposure.apply()
+            dark = self.dark_reference(exposure)
+
+            max_frames = self._settings.get_int(["scan_max_frames"])
+            if self.frame_stack is None or self.frame_stack.capacity < max_frames:
+                self.frame_stack = acquisition.FrameStack(max_frames)
+
+            def classify(spectrum):
+                materials, confidences = prediction.predict_with_confidence(exposures.normalize(spectrum, exposure).reshape(1, -1), 'R')
+                return materials[0], confidences[0]
+
+            spect.shutterLEDs(True)
+            result = acquisition.sequential_scan(
+                classify, dark, self.frame_stack,
+                confidence_threshold=self._settings.get_float(["scan_confidence"]),
+                stable_frames=self._settings.get_int(["scan_stable_frames"]),
+                time_budget=self._settings.get_float(["scan_time_budget"]),
+                method=self._settings.get(["frame_combine"]),
+                max_frames=max_frames,
+            )
+            self._logger.info(f"Sequential scan: {result}")
+            self.check_clipping(exposure)
+
+            self.last_spectrum = exposures.normalize(result.spectrum, exposure)
+            self.last_variance = result.variance
+            self.prediction_confidence = result.confidence
+            self.predicted_material = result.material
+            self.record_scan(dark, result.spectrum + dark.values, exposure, result.frames, "sequential")
+            self.count_scan("sequential", result.frames, time.monotonic() - start)
+            return result
+        except Exception as e:
+            SCAN_FAILURES.inc(mode="sequential")
+            self._logger.error(f"Error reading spectrometer data: {e}")
+
     def start_spectrometer(self):
         """Starts a separate thread for reading spectrometer data."""
         if self.spectrometer_running:
@@ -250,56 +654,122 @@ class PFVSPlugin(octoprint.plugin.SettingsPlugin,
         
         # Add if statement to see if there is filament detected first before running a scan
         self.spectrometer_running = True
-        self.spectrometer_thread = threading.Thread(target=self.read_spectrometer_data, daemon=True)
+        self.live_stopped = threading.Event()
+        self.spectrometer_thread = threading.Thread(target=self.read_spectrometer_data, args=(self.live_stopped,),
+                                                    daemon=True)
         self.spectrometer_thread.start()
         self._logger.info("Spectrometer data collection started.")
 
     def stop_spectrometer(self):
-        """Stops the spectrometer thread."""
-        spect.shutterLED("AS72651", False)
-        spect.shutterLED("AS72652", False)
-        spect.shutterLED("AS72653", False)
-        self.spectrometer_running = False
+        """Stops the spectrometer thread, it switches the LEDs off on its way out."""
+        with self.live_lock:
+            self.spectrometer_running = False
+            if self.live_stopped is not None:
+                self.live_stopped.set()
+            if self.live_pipeline is not None:
+                self.live_pipeline.stop()
         self._logger.info("Stopping spectrometer data collection.")
 
-    def read_spectrometer_data(self):
-        """Reads data from the spectrometer and sends it to the web interface."""
+    def read_spectrometer_data(self, stopped):
+        """
+        Reads data from the spectrometer and streams it to the web interface until ``stopped`` is
+        set. A stream that is still winding down never touches the state of one started after it.
+        """
+        publisher = streaming.SpectrumPublisher(
+            lambda payload: self._plugin_manager.send_plugin_message(self._identifier, payload),
+            max_rate=self._settings.get_float(["stream_max_rate"]),
+            encoding=self._settings.get(["stream_encoding"]),
+            min_change=self._settings.get_float(["stream_min_change"]),
+            keepalive=self._settings.get_float(["stream_keepalive"]),
+        )
+        live = None
         try:
-            spect.setGain(3)
-            spect.setIntegrationTime(63)
-            spect.shutterLED("AS72651", False)
-            spect.shutterLED("AS72652", False)
-            spect.shutterLED("AS72653", False)
-            time.sleep(0.18)
-            dark_spect_data = spect.readRAW()
-            self._logger.info(f"Raw Dark Spectrometer Data: {dark_spect_data}")
-            time.sleep(1.0)  
-
-            spect.shutterLED("AS72651", True)
-            spect.shutterLED("AS72652", True)
-            spect.shutterLED("AS72653", True)
-            while self.spectrometer_running:
-                # Reading spectrometer data
-                time.sleep(0.18)
-                light_spect_data = spect.readRAW() 
-
-                for i in range(len(light_spect_data)):
-                    light_spect_data[i] = light_spect_data[i] - dark_spect_data[i]
-                
-                # Finally, pass the spectrometer data to the prediction function
-                self._logger.info(f"Raw Spectrometer Data: {light_spect_data}")
-                predicted_material = predict_material(light_spect_data, 'R')
-                self._logger.info(f"Predicted material: {predicted_material}")
-
-                # Send data to web UI
-                self._plugin_manager.send_plugin_message(
-                    self._identifier, 
-                    {"spectrometer_data": light_spect_data, "predicted_material": predicted_material}
-                )
-                
-                time.sleep(1)  # Adjust sampling rate
+            # The bus belongs to the arbiter, so a scan can slip in between any two live frames
+            exposure, dark = self.arbiter.run(self.prepare_live_stream, "live stream setup", priority=PRIORITY_LIVE)
+            self._logger.debug(f"Raw Dark Spectrometer Data: {dark.values.tolist()}")
+            acquire_frame = functools.partial(self.acquire_live_frame, exposure)
+            predicted_material = None
+
+            def acquire():
+                # The conversion the previous frame started integrates without holding the arbiter
+                delay = self.live_ready_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                return self.arbiter.run(acquire_frame, "live frame", priority=PRIORITY_LIVE, key="live frame")
+
+            def process(frames, counts):
+                nonlocal predicted_material
+                with tracer.trace("live_batch", frames=int(counts.sum())):
+                    light_spect_data = exposures.normalize(frames - dark.values, exposure)
+
+                    # One vectorized prediction for everything acquired since the last batch
+                    materials = prediction.predict_materials(light_spect_data, 'R')
+                    if materials[-1] != predicted_material:
+                        predicted_material = str(materials[-1])
+                        self._logger.info(f"Predicted material: {predicted_material}")
+
+                    # Send data to web UI, rate limited and coalesced
+                    with tracer.span("publish"):
+                        for spectrum, material in zip(light_spect_data, materials):
+                            publisher.publish(spectrum, str(material), fps=round(live.stats()["acquire_fps"], 2))
+                self.count_live_frames(live)
+
+            live = pipeline.LivePipeline(
+                acquire, process,
+                frame_rate=self._settings.get_float(["live_frame_rate"]),
+                capacity=self._settings.get_int(["live_buffer"]),
+                max_batch=self._settings.get_int(["live_batch"]),
+                overflow=self._settings.get(["live_overflow"]),
+            )
+            with self.live_lock:
+                if stopped.is_set():
+                    live.stop()  # Stopped while the stream was being set up
+                else:
+                    self.live_pipeline = live
+            live.run()
+            publisher.flush()
         except Exception as e:
             self._logger.error(f"Error reading spectrometer data: {e}")
+        with self.live_lock:
+            if not stopped.is_set():
+                # Ended on its own, so this is still the current stream
+                stopped.set()
+                self.spectrometer_running = False
+        self.arbiter.submit("live stream stop", fn=functools.partial(spect.shutterLEDs, False),
+                            priority=PRIORITY_LIVE, key="live stream stop")
+        self._logger.info(f"Live stream stopped: {publisher.stats()}, {live.stats() if live else {}}")
+
+    def count_live_frames(self, live):
+        stats = live.stats()
+        LIVE_FRAME_RATE.set(stats["acquire_fps"])
+        for outcome in ("processed", "merged", "dropped"):
+            LIVE_FRAMES.set_total(stats[outcome], outcome=outcome)
+
+    def prepare_live_stream(self):
+        """Runs on the arbiter thread: exposure and dark reference for the live stream."""
+        exposure = self.scan_exposure()
+        exposure.apply()
+        self.live_conversion = None
+        self.live_ready_at = 0.0
+        return exposure, self.dark_reference(exposure)
+
+    @traced(root=True)
+    def acquire_live_frame(self, exposure):
+        """
+        Runs on the arbiter thread: reads the conversion the previous frame started and starts the
+        next one, so the sensor integrates while the arbiter serves others and the frame is
+        classified. If a scan used the device in between, the exposure and LEDs are set again and
+        the conversion is redone; the driver skips the writes when nothing changed.
+        """
+        exposure.apply()
+        spect.shutterLEDs(True)
+        if not spect.conversionRunning(self.live_conversion):
+            spect.startMeasurement()
+        spect.waitDataReady()
+        frame = np.asarray(spect.readRAW())
+        self.live_conversion = spect.startMeasurement()
+        self.live_ready_at = self.live_conversion + spect.conversionTime()
+        return frame
 
     ##~~ Software update hook
 
@@ -321,6 +791,8 @@ class PFVSPlugin(octoprint.plugin.SettingsPlugin,
     @octoprint.plugin.BlueprintPlugin.route("/start_spectrometer", methods=["POST"])
     def api_start_spectrometer(self):
         """API endpoint to start spectrometer via UI."""
+        if not self.readiness.ready:
+            return jsonify(status="Spectrometer not ready", **self.readiness.snapshot()), 503
         self.start_spectrometer()
         return jsonify(status="Spectrometer started")
 
@@ -330,6 +802,128 @@ class PFVSPlugin(octoprint.plugin.SettingsPlugin,
         self.stop_spectrometer()
         return jsonify(status="Spectrometer stopped")
 
+    @octoprint.plugin.BlueprintPlugin.route("/status", methods=["GET"])
+    def api_status(self):
+        """
+        API endpoint reporting whether the plugin is initializing, ready or failed (and why), plus the
+        last scan's combined spectrum (normalized) and the per-channel variance of its RAW frames.
+        """
+        last_scan = None
+        if self.last_spectrum is not None:
+            last_scan = {"material": self.predicted_material, "confidence": self.prediction_confidence,
+                         "spectrum": self.last_spectrum.tolist(), "variance": self.last_variance.tolist()}
+        return jsonify(dict(self.readiness.snapshot(), arbiter=self.arbiter.stats(), last_scan=last_scan,
+                            live=self.live_pipeline.stats() if self.live_pipeline is not None else None,
+                            presence=self.presence.stats() if self.presence is not None else None))
+
+    @octoprint.plugin.BlueprintPlugin.route("/model_stats", methods=["GET"])
+    def api_model_stats(self):
+        """API endpoint reporting classifier load time and cache hits."""
+        if not model_registry.loaded:
+            return jsonify(loaded=False, **self.readiness.snapshot())
+        return jsonify(model_registry.get_registry().stats())
+
+    @octoprint.plugin.BlueprintPlugin.route("/model", methods=["POST"])
+    def api_install_model(self):
+        """API endpoint installing a model bundle, sent as the "file" form field or as the request body."""
+        if not self.readiness.ready:
+            return jsonify(status="Classifier not ready", **self.readiness.snapshot()), 503
+        upload = request.files.get("file")
+        data = upload.read() if upload is not None else request.get_data()
+        if not data:
+            return jsonify(status="No model bundle received"), 400
+
+        # Uploads get their own file each, two at once must not write into the same one
+        with tempfile.NamedTemporaryFile(dir=self.get_plugin_data_folder(), prefix="upload", suffix=".pfvsmodel",
+                                         delete=False) as f:
+            f.write(data)
+            path = f.name
+        try:
+            manifest = model_registry.get_registry().install(path)
+        except model_bundle.BundleError as e:
+            self._logger.warning(f"Rejected model bundle: {e}")
+            return jsonify(status="Invalid model bundle", error=str(e)), 400
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+        # Results of the old model must not be handed out as fresh scans
+        self.arbiter.expire()
+        return jsonify(status="Model installed", manifest=manifest)
+
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def api_metrics(self):
+        """API endpoint with all plugin metrics in the Prometheus text format."""
+        return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+    @octoprint.plugin.BlueprintPlugin.route("/traces", methods=["GET"])
+    def api_traces(self):
+        """API endpoint with the most recent scan traces, newest first: ?limit=&name="""
+        traces = tracer.traces(limit=request.args.get("limit", type=int), name=request.args.get("name"))
+        return jsonify(dict(tracer.stats(), traces=traces))
+
+    @octoprint.plugin.BlueprintPlugin.route("/traces", methods=["POST"])
+    def api_configure_tracing(self):
+        """API endpoint switching tracing on or off at runtime: {"enabled": bool, "capacity": int, "clear": bool}"""
+        data = request.get_json(silent=True) or {}
+        tracer.configure(enabled=data.get("enabled"), capacity=data.get("capacity"))
+        if data.get("clear"):
+            tracer.clear()
+        return jsonify(tracer.stats())
+
+    def _history_filters(self):
+        return {
+            "start": request.args.get("start", type=float),
+            "end": request.args.get("end", type=float),
+            "material": request.args.get("material") or None,
+        }
+
+    def _history_unavailable(self):
+        """The error response while the history cannot be read: 503 until initialized, 404 if disabled."""
+        if self.history is not None:
+            return None
+        if not self.readiness.ready:
+            return jsonify(status="Scan history not ready", **self.readiness.snapshot()), 503
+        return jsonify(error="Scan history is disabled"), 404
+
+    @octoprint.plugin.BlueprintPlugin.route("/history", methods=["GET"])
+    def api_history(self):
+        """API endpoint for a page of past scans: ?start=&end=&material=&offset=&limit=&spectra=1"""
+        unavailable = self._history_unavailable()
+        if unavailable is not None:
+            return unavailable
+        page = self.history.query(
+            offset=max(0, request.args.get("offset", 0, type=int)),
+            limit=min(1000, max(1, request.args.get("limit", 100, type=int))),
+            include_spectra=request.args.get("spectra", "0") in ("1", "true"),
+            **self._history_filters()
+        )
+        return jsonify(page)
+
+    @octoprint.plugin.BlueprintPlugin.route("/history/export", methods=["GET"])
+    def api_history_export(self):
+        """API endpoint exporting the matching scans as a NumPy .npz archive."""
+        unavailable = self._history_unavailable()
+        if unavailable is not None:
+            return unavailable
+        return Response(
+            self.history.export(**self._history_filters()),
+            mimetype="application/octet-stream",
+            headers={"Content-Disposition": "attachment; filename=pfvs_scans.npz"},
+        )
+
+    @octoprint.plugin.BlueprintPlugin.route("/history/stats", methods=["GET"])
+    def api_history_stats(self):
+        """API endpoint reporting the size of the scan history."""
+        unavailable = self._history_unavailable()
+        if unavailable is not None:
+            return unavailable
+        return jsonify(self.history.stats())
+
+def register_custom_events(*args, **kwargs):
+    """Fired by the presence monitor as plugin_pfvs_filament_inserted / plugin_pfvs_filament_removed."""
+    return ["filament_inserted", "filament_removed"]
+
 __plugin_name__ = "PFVS Plugin"
 __plugin_pythoncompat__ = ">=3,<4"
 
@@ -341,4 +935,6 @@ def __plugin_load__():
     __plugin_hooks__ = {
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
         "octoprint.comm.protocol.gcode.received": (__plugin_implementation__.process_gcode, 1),
+        "octoprint.comm.protocol.temperatures.received": (__plugin_implementation__.process_temperatures, 1),
+        "octoprint.events.register_custom_events": register_custom_events,
     }
@@ -0,0 +1,284 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+from octoprint_pfvs import spectrometer as spect
+from octoprint_pfvs.tracing import traced, tracer
+
+COMBINE_METHODS = ("mean", "median", "sigma_clip")
+
+
+class DarkFrame:
+    """A dark reference (LEDs off) and the conditions it was taken under."""
+    def __init__(self, values, gain, integration_time, temperatures, acquired_at=None):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.gain = gain
+        self.integration_time = integration_time
+        self.temperatures = list(temperatures) if temperatures is not None else None
+        self.acquired_at = time.monotonic() if acquired_at is None else acquired_at
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.acquired_at
+
+
+class DarkFrameCache:
+    """
+    Dark references keyed by (gain, integration time).
+
+    An entry is stale once it is older than ``max_age`` seconds or when any of the three sensor
+    temperatures moved more than ``max_temp_drift`` degrees since it was taken, since the dark
+    current of the sensors depends on both.
+    """
+    def __init__(self, max_age: float = 300.0, max_temp_drift: float = 2.0):
+        self.max_age = max_age
+        self.max_temp_drift = max_temp_drift
+        self._frames = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "drifted": 0, "stored": 0}
+
+    def _stale_reason(self, frame, temperatures):
+        if frame.age > self.max_age:
+            return "expired"
+        if temperatures is not None and frame.temperatures is not None:
+            drift = max(abs(now - then) for now, then in zip(temperatures, frame.temperatures))
+            if drift > self.max_temp_drift:
+                return "drifted"
+        return None
+
+    def get(self, gain, integration_time, temperatures=None):
+        """Returns the cached DarkFrame for these settings, or None if there is no fresh one."""
+        with self._lock:
+            frame = self._frames.get((gain, integration_time))
+            if frame is None:
+                self._stats["misses"] += 1
+                return None
+
+            reason = self._stale_reason(frame, temperatures)
+            if reason is not None:
+                del self._frames[(gain, integration_time)]
+                self._stats[reason] += 1
+                self._stats["misses"] += 1
+                return None
+
+            self._stats["hits"] += 1
+            return frame
+
+    def needs_refresh(self, gain, integration_time, temperatures=None, margin: float = 0.0) -> bool:
+        """True if there is no entry for these settings or it is stale (or will be within ``margin`` seconds)."""
+        with self._lock:
+            frame = self._frames.get((gain, integration_time))
+            if frame is None:
+                return True
+            return frame.age + margin > self.max_age or self._stale_reason(frame, temperatures) is not None
+
+    def put(self, frame: DarkFrame):
+        with self._lock:
+            self._frames[(frame.gain, frame.integration_time)] = frame
+            self._stats["stored"] += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._frames.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = [
+                {"gain": gain, "integration_time": integration_time, "age": frame.age, "temperatures": frame.temperatures}
+                for (gain, integration_time), frame in self._frames.items()
+            ]
+            return stats
+
+
+@traced()
+def acquire_dark_frame(gain, integration_time, cache=None, temperatures=None) -> DarkFrame:
+    """
+    Switches the shutter LEDs off and reads a dark reference at the given settings.
+
+    The spectrometer must already be configured for ``gain`` and ``integration_time``.
+    """
+    if temperatures is None:
+        temperatures = spect.temperatures()
+    spect.shutterLEDs(False)
+    # The conversion starts after the LEDs are off, so no light from them ends up in the frame
+    spect.takeMeasurement()
+    frame = DarkFrame(spect.readRAW(), gain, integration_time, temperatures)
+    if cache is not None:
+        cache.put(frame)
+    logging.getLogger("octoprint.plugins.pfvs").debug(
+        f"Acquired dark frame at gain {gain}, integration time {integration_time}, temperatures {temperatures}"
+    )
+    return frame
+
+
+def get_dark_frame(cache, gain, integration_time):
+    """
+    Returns a dark reference from the cache, acquiring a new one if needed.
+
+    Returns:
+        tuple: (DarkFrame, bool) where the bool tells whether a new frame was acquired.
+    """
+    temperatures = spect.temperatures()
+    frame = cache.get(gain, integration_time, temperatures)
+    if frame is not None:
+        return frame, False
+    return acquire_dark_frame(gain, integration_time, cache, temperatures), True
+
+
+class FrameStack:
+    """Preallocated K x 18 buffer that light frames are read into."""
+    def __init__(self, capacity: int, channels: int = 18):
+        if capacity < 1:
+            raise ValueError("A frame stack needs room for at least one frame.")
+        self.buffer = np.empty((capacity, channels), dtype=np.float64)
+        self.count = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.buffer.shape[0]
+
+    @property
+    def frames(self) -> np.ndarray:
+        return self.buffer[:self.count]
+
+    def add(self, frame):
+        if self.count >= self.capacity:
+            raise IndexError("Frame stack is full.")
+        self.buffer[self.count] = frame
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+
+    def combine(self, method: str = "mean", sigma: float = 3.0):
+        return combine_frames(self.frames, method, sigma)
+
+
+@traced()
+def combine_frames(frames, method: str = "mean", sigma: float = 3.0, iterations: int = 3):
+    """
+    Combines a K x 18 stack of frames into one spectrum.
+
+    Parameters:
+        frames (np.array): K x 18 frames.
+        method (str): "mean", "median" or "sigma_clip" (mean after iteratively rejecting values
+            more than ``sigma`` robust standard deviations from the channel median).
+
+    Returns:
+        tuple: (spectrum, variance), both 18 values. The variance is the per-channel sample
+        variance of the frames that were used (zero for a single frame).
+    """
+    frames = np.asarray(frames, dtype=np.float64)
+    if frames.ndim != 2 or frames.shape[0] == 0:
+        raise ValueError("Need at least one frame to combine.")
+    if method not in COMBINE_METHODS:
+        raise ValueError(f"Unknown combine method '{method}', expected one of {COMBINE_METHODS}")
+
+    keep = np.ones(frames.shape, dtype=bool)
+    if method == "sigma_clip" and frames.shape[0] > 2:
+        for _ in range(iterations):
+            masked = np.where(keep, frames, np.nan)
+            center = np.nanmedian(masked, axis=0)
+            # Robust spread (scaled median absolute deviation), a single outlier would inflate the std
+            spread = 1.4826 * np.nanmedian(np.abs(masked - center), axis=0)
+            spread = np.where(spread > 0, spread, np.nanstd(masked, axis=0))
+            new_keep = np.abs(frames - center) <= sigma * spread
+            # Never reject every frame of a channel
+            new_keep[:, ~new_keep.any(axis=0)] = True
+            if np.array_equal(new_keep, keep):
+                break
+            keep = new_keep
+
+    used = keep.sum(axis=0)
+    masked = np.where(keep, frames, 0.0)
+    mean = masked.sum(axis=0) / used
+    variance = np.where(keep, (frames - mean) ** 2, 0.0).sum(axis=0) / np.maximum(used - 1, 1)
+
+    if method == "median":
+        return np.median(frames, axis=0), variance
+    return mean, variance
+
+
+@traced()
+def acquire_frames(count: int, stack: FrameStack = None) -> FrameStack:
+    """
+    Reads ``count`` RAW light frames into ``stack`` (a new one if not given).
+
+    Each frame is a fresh one-shot conversion, so a frame takes as long as the integration time
+    needs. The shutter LEDs and the sensor settings have to be set up by the caller.
+    """
+    if stack is None or stack.capacity < count:
+        stack = FrameStack(count)
+    stack.reset()
+    for _ in range(count):
+        spect.takeMeasurement()
+        stack.add(spect.readRAW())
+    return stack
+
+
+class SequentialScanResult:
+    """Outcome of a sequential scan."""
+    def __init__(self, material, confidence, spectrum, variance, frames, elapsed, reason):
+        self.material = material
+        self.confidence = confidence
+        self.spectrum = spectrum
+        self.variance = variance
+        self.frames = frames
+        self.elapsed = elapsed
+        self.reason = reason
+
+    def __repr__(self):
+        return (f"SequentialScanResult({self.material}, confidence={self.confidence:.2f}, "
+                f"frames={self.frames}, elapsed={self.elapsed:.2f}s, reason={self.reason})")
+
+
+@traced()
+def sequential_scan(classify, dark, stack: FrameStack, confidence_threshold: float = 1.0,
+                    stable_frames: int = 2, time_budget: float = 3.0, method: str = "mean",
+                    max_frames: int = None) -> SequentialScanResult:
+    """
+    Takes light frames until the prediction is stable and confident enough.
+
+    After every frame the frames so far are combined, the dark reference is subtracted and the
+    result is classified. The scan stops once the last ``stable_frames`` predictions agree and
+    the confidence reached ``confidence_threshold``, after ``max_frames`` frames, or when the
+    next frame would not fit into ``time_budget`` seconds.
+
+    Parameters:
+        classify (callable): Takes an 18 value spectrum, returns (material, confidence).
+        dark (DarkFrame): Dark reference for the current settings.
+        stack (FrameStack): Buffer for the frames.
+        max_frames (int): Most frames to take, at most (and by default) the stack's capacity.
+    """
+    max_frames = stack.capacity if max_frames is None else min(max_frames, stack.capacity)
+    start = time.monotonic()
+    stack.reset()
+    history = []
+    reason = "max_frames"
+    frame_time = 0.0
+
+    while stack.count < max_frames:
+        with tracer.span("frame", index=stack.count) as span:
+            frame_start = time.monotonic()
+            spect.takeMeasurement()
+            stack.add(spect.readRAW())
+
+            light, variance = stack.combine(method)
+            spectrum = light - dark.values
+            material, confidence = classify(spectrum)
+            span.set(material=material, confidence=float(confidence))
+            history.append(material)
+            frame_time = max(frame_time, time.monotonic() - frame_start)
+
+        if len(history) >= stable_frames and len(set(history[-stable_frames:])) == 1 and confidence >= confidence_threshold:
+            reason = "confident"
+            break
+        if time.monotonic() - start + frame_time > time_budget:
+            reason = "time_budget"
+            break
+
+    return SequentialScanResult(material, float(confidence), spectrum, variance, stack.count,
+                                time.monotonic() - start, reason)
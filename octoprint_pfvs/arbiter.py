@@ -0,0 +1,154 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+PRIORITY_SCAN = 0  # Verification scans, a print may be waiting on them
+PRIORITY_MAINTENANCE = 1  # Dark frame refreshes and similar upkeep
+PRIORITY_LIVE = 2  # Live preview frames, dropped behind everything else
+
+
+class SpectrometerArbiter:
+    """
+    Sole owner of the spectrometer: every job that touches the I2C bus runs on its one thread.
+
+    Jobs are queued with a priority (lower runs first, FIFO within a priority), so a scan gating
+    a print overtakes queued live preview frames. Jobs are coalesced by ``key`` (the function by
+    default): submitting while the same job is queued or running returns that job's future, so
+    concurrent requesters share one acquisition, and resubmitting a queued job at a higher
+    priority moves it up. With ``reuse_within`` a job that finished that many seconds ago is
+    shared too, which turns back-to-back requests into a single acquisition.
+    """
+    def __init__(self, scan_fn, logger=None):
+        self._scan_fn = scan_fn
+        self._logger = logger or logging.getLogger("octoprint.plugins.pfvs")
+        self._queue = queue.PriorityQueue()
+        self._lock = threading.Lock()
+        self._pending = {}  # key -> future, queued or running
+        self._finished = {}  # key -> (future, monotonic finish time)
+        self._running = None
+        self._tickets = itertools.count(1)
+        self._stats = {"submitted": 0, "coalesced": 0, "reused": 0, "promoted": 0, "completed": 0, "failed": 0,
+                       "cancelled": 0}
+        self._thread = threading.Thread(target=self._run_loop, name="pfvs-spectrometer", daemon=True)
+        self._thread.start()
+
+    @property
+    def busy(self) -> bool:
+        """True while a filament scan is queued or running."""
+        with self._lock:
+            return self._scan_fn in self._pending
+
+    @property
+    def idle(self) -> bool:
+        """True if no job of any kind is queued or running."""
+        with self._lock:
+            return not self._pending
+
+    def submit(self, reason: str, callback=None, fn=None, priority: int = PRIORITY_SCAN, key=None,
+               reuse_within: float = 0.0) -> Future:
+        """
+        Queues a scan (or ``fn`` instead) and returns its future immediately.
+
+        The future carries a ``ticket`` (increasing int) and the ``reason`` it was requested for.
+        ``callback`` is called with the future once the job finished, on the arbiter thread; it is
+        only attached when this call queued a new job.
+        """
+        fn = fn or self._scan_fn
+        key = fn if key is None else key
+        log = self._logger.debug if priority >= PRIORITY_LIVE else self._logger.info
+        with self._lock:
+            self._stats["submitted"] += 1
+            pending = self._pending.get(key)
+            if pending is not None:
+                self._stats["coalesced"] += 1
+                if priority < pending.priority and pending is not self._running:
+                    # Queue it again at the new priority, the old entry is skipped once it comes up
+                    pending.priority = priority
+                    self._queue.put((priority, pending.ticket, pending, fn))
+                    self._stats["promoted"] += 1
+                self._logger.debug(f"Job #{pending.ticket} already pending, sharing it with {reason}")
+                return pending
+
+            finished, finished_at = self._finished.get(key, (None, 0.0))
+            if finished is not None and time.monotonic() - finished_at <= reuse_within:
+                self._stats["reused"] += 1
+                self._logger.debug(f"Job #{finished.ticket} finished {time.monotonic() - finished_at:.2f}s ago, "
+                                   f"sharing its result with {reason}")
+                return finished
+
+            future = Future()
+            future.ticket = next(self._tickets)
+            future.reason = reason
+            future.priority = priority
+            future.key = key
+            if callback is not None:
+                future.add_done_callback(callback)
+            self._pending[key] = future
+            self._queue.put((priority, future.ticket, future, fn))
+
+        log(f"Queued job #{future.ticket} ({reason})")
+        return future
+
+    def run(self, fn, reason: str, priority: int = PRIORITY_SCAN, key=None, timeout=None):
+        """Runs ``fn`` on the arbiter thread and waits for its result, for callers that need the device."""
+        return self.submit(reason, fn=fn, priority=priority, key=key).result(timeout)
+
+    def expire(self, key=None):
+        """Stops sharing finished results of ``key`` (the scan by default), e.g. once the spool changed."""
+        with self._lock:
+            self._finished.pop(self._scan_fn if key is None else key, None)
+
+    def _run_loop(self):
+        while True:
+            priority, ticket, future, fn = self._queue.get()
+            if future is None:
+                return
+            if future.priority != priority:
+                continue  # Promoted, it already ran from its new place in the queue
+            if not future.set_running_or_notify_cancel():
+                self._finish(future, "cancelled")
+                continue
+
+            with self._lock:
+                self._running = future
+            log = self._logger.debug if priority >= PRIORITY_LIVE else self._logger.info
+            start = time.monotonic()
+            try:
+                result = fn()
+            except BaseException as e:
+                self._finish(future, "failed")
+                future.set_exception(e)
+            else:
+                log(f"Job #{ticket} ({future.reason}) finished in {time.monotonic() - start:.2f}s: {result}")
+                self._finish(future, "completed")
+                future.set_result(result)
+
+    def _finish(self, future, outcome):
+        # Unregistered before the result is set so done callbacks can queue the same job again
+        with self._lock:
+            self._running = None
+            if self._pending.get(future.key) is future:
+                del self._pending[future.key]
+            if outcome == "completed":
+                self._finished[future.key] = (future, time.monotonic())
+            self._stats[outcome] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["queued"] = len(self._pending) - (self._running is not None)
+            stats["running"] = self._running.reason if self._running is not None else None
+            return stats
+
+    def shutdown(self, wait=False):
+        """Cancels queued jobs and stops the thread once the running job finished."""
+        with self._lock:
+            pending = [future for future in self._pending.values() if future is not self._running]
+        for future in pending:
+            future.cancel()
+        self._queue.put((float("inf"), 0, None, None))
+        if wait:
+            self._thread.join()
@@ -0,0 +1,178 @@
+import logging
+import math
+import threading
+
+import numpy as np
+
+from octoprint_pfvs import spectrometer as spect
+from octoprint_pfvs.tracing import traced
+
+FULL_SCALE = 65535  # 16-bit RAW channels
+REFERENCE_GAIN = 3  # Settings the classifier was trained on, spectra are normalized to them
+REFERENCE_INTEGRATION_TIME = 63
+
+
+class Exposure:
+    """A gain / integration time pair."""
+    def __init__(self, gain: int, integration_time: int):
+        self.gain = int(gain)
+        self.integration_time = int(integration_time)
+
+    @property
+    def factor(self) -> float:
+        """Counts scale linearly with this, relative units."""
+        return exposure_factor(self.gain, self.integration_time)
+
+    def apply(self):
+        spect.setGain(self.gain)
+        spect.setIntegrationTime(self.integration_time)
+
+    def __eq__(self, other):
+        return isinstance(other, Exposure) and (self.gain, self.integration_time) == (other.gain, other.integration_time)
+
+    def __repr__(self):
+        return f"Exposure(gain={self.gain}, integration_time={self.integration_time})"
+
+
+REFERENCE_EXPOSURE = Exposure(REFERENCE_GAIN, REFERENCE_INTEGRATION_TIME)
+
+
+def exposure_factor(gain, integration_time) -> float:
+    return spect.GAIN_FACTORS[gain] * integration_time
+
+
+def normalize(spectrum, exposure: Exposure) -> np.ndarray:
+    """Scales dark-subtracted counts taken at ``exposure`` to what the reference exposure would have read."""
+    return np.asarray(spectrum, dtype=np.float64) * (REFERENCE_EXPOSURE.factor / exposure.factor)
+
+
+def exposure_for(factor, min_integration_time=1, max_integration_time=255, max_gain=3) -> Exposure:
+    """
+    The exposure closest to ``factor`` (rounded down so it never overshoots) with the shortest
+    integration time, i.e. the highest gain whose integration time stays within the limits.
+    """
+    for gain in range(max_gain, -1, -1):
+        integration_time = math.floor(factor / spect.GAIN_FACTORS[gain])
+        if integration_time >= min_integration_time:
+            return Exposure(gain, min(integration_time, max_integration_time))
+    return Exposure(0, min_integration_time)
+
+
+class AutoExposureResult:
+    def __init__(self, exposure, peak, measurements, reason):
+        self.exposure = exposure
+        self.peak = peak
+        self.measurements = measurements
+        self.reason = reason
+
+    def __repr__(self):
+        return (f"AutoExposureResult({self.exposure}, peak={self.peak:.0f}, "
+                f"measurements={self.measurements}, reason={self.reason})")
+
+
+@traced()
+def auto_expose(target_low: float = 0.004, target_high: float = 0.012, start: Exposure = None,
+                max_exposure: Exposure = REFERENCE_EXPOSURE, min_integration_time: int = 1,
+                max_measurements: int = 5) -> AutoExposureResult:
+    """
+    Finds the shortest exposure whose brightest RAW channel lands in the target band.
+
+    Starts from a short exposure and rescales by the measured peak, since counts are linear in
+    gain x integration time. A clipped measurement says nothing about how far over it is, so the
+    exposure is cut by 8 instead. Exposures longer than ``max_exposure`` are never used: a
+    filament too dark for the band at ``max_exposure`` simply gets ``max_exposure``, without
+    measuring it there once the rescale already shows it would stay below the band.
+
+    The shutter LEDs have to be on. The band is given as fractions of full scale.
+
+    Returns:
+        AutoExposureResult: The chosen exposure (already applied), its peak and why the search stopped.
+    """
+    low, high = target_low * FULL_SCALE, target_high * FULL_SCALE
+    target = (low + high) / 2
+    max_gain = max_exposure.gain
+    limits = {"min_integration_time": min_integration_time, "max_gain": max_gain,
+              "max_integration_time": max(max_exposure.integration_time, min_integration_time)}
+    exposure = start or exposure_for(max_exposure.factor / 16, **limits)
+
+    reason = "max_measurements"
+    for measurement in range(1, max_measurements + 1):
+        exposure.apply()
+        spect.takeMeasurement()
+        peak = float(max(spect.readRAW()))
+
+        if peak >= FULL_SCALE:
+            factor = exposure.factor / 8
+        elif low <= peak <= high:
+            reason = "in_band"
+            break
+        else:
+            factor = exposure.factor * target / max(peak, 1.0)
+            if peak * max_exposure.factor / exposure.factor < low:
+                # Counts are linear, even the longest exposure would not reach the band
+                peak *= max_exposure.factor / exposure.factor  # Estimated, not measured
+                exposure = exposure_for(max_exposure.factor, **limits)
+                exposure.apply()
+                reason = "max_exposure"
+                break
+
+        factor = min(factor, max_exposure.factor)
+        candidate = exposure_for(factor, **limits)
+        if candidate == exposure:
+            reason = "max_exposure" if peak < low else "min_exposure"
+            break
+        exposure = candidate
+    else:
+        # Out of measurements, the last rescale is still the best estimate
+        exposure.apply()
+
+    logging.getLogger("octoprint.plugins.pfvs").debug(
+        f"Auto exposure picked {exposure} (peak {peak:.0f}) after {measurement} measurements: {reason}"
+    )
+    return AutoExposureResult(exposure, peak, measurement, reason)
+
+
+class ExposureCache:
+    """
+    Exposures picked by auto_expose, per spool.
+
+    The spool id is bumped by the plugin whenever filament is loaded or unloaded, so a new spool
+    never inherits the settings of the previous one.
+    """
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self._exposures = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stored": 0, "invalidated": 0}
+
+    def get(self, spool_id):
+        with self._lock:
+            exposure = self._exposures.get(spool_id)
+            self._stats["hits" if exposure is not None else "misses"] += 1
+            return exposure
+
+    def peek(self, spool_id):
+        """Like get, without counting towards the stats."""
+        with self._lock:
+            return self._exposures.get(spool_id)
+
+    def put(self, spool_id, exposure: Exposure):
+        with self._lock:
+            self._exposures.pop(spool_id, None)
+            self._exposures[spool_id] = exposure
+            while len(self._exposures) > self.max_entries:
+                del self._exposures[next(iter(self._exposures))]
+            self._stats["stored"] += 1
+
+    def invalidate(self, spool_id=None):
+        with self._lock:
+            if spool_id is None:
+                self._exposures.clear()
+            elif self._exposures.pop(spool_id, None) is not None:
+                self._stats["invalidated"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = {spool_id: repr(exposure) for spool_id, exposure in self._exposures.items()}
+            return stats
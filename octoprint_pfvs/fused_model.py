@@ -0,0 +1,180 @@
+"""
+NumPy-only inference engine for the filament classifier.
+
+StandardScaler and PCA are both affine, so ``pca.transform(scaler.transform(x))`` collapses
+into ``x @ W + b``. The appended color column only ever takes one of a handful of encoded
+values, so its contribution is folded into a per-color offset. For a linear SVM the one-vs-one
+decision values are affine in the PCA features as well, and the whole pipeline reduces to a
+single 18 x n_pairs matrix plus a per-color offset. Other kernels keep the support vectors and
+evaluate the kernel in NumPy.
+
+The engine is shipped as a model bundle, see ``octoprint_pfvs.model_bundle``.
+"""
+import os
+
+import numpy as np
+
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+SUPPORTED_KERNELS = ("linear", "rbf")
+
+
+class FusedModel:
+    """Scaler, PCA and SVM decision function precomputed into plain NumPy arrays."""
+    def __init__(self, kernel, weights, color_offsets, color_classes, material_classes,
+                 intercept, support_vectors=None, dual_coef=None, gamma=0.0):
+        self.kernel = str(kernel)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.color_offsets = np.asarray(color_offsets, dtype=np.float64)
+        self.color_classes = np.asarray(color_classes)
+        self.material_classes = np.asarray(material_classes)
+        self.intercept = np.asarray(intercept, dtype=np.float64)
+        self.support_vectors = None if support_vectors is None else np.asarray(support_vectors, dtype=np.float64)
+        self.dual_coef = None if dual_coef is None else np.asarray(dual_coef, dtype=np.float64)
+        self.gamma = float(gamma)
+
+        n_classes = len(self.material_classes)
+        self._pairs = [(i, j) for i in range(n_classes) for j in range(i + 1, n_classes)]
+
+    @property
+    def n_channels(self) -> int:
+        return self.weights.shape[0]
+
+    def encode_colors(self, color_labels) -> np.ndarray:
+        """Maps color labels to row indices of ``color_offsets``, rejecting unseen labels like LabelEncoder."""
+        color_labels = np.asarray(color_labels)
+        indices = np.searchsorted(self.color_classes, color_labels)
+        indices = np.clip(indices, 0, len(self.color_classes) - 1)
+        unseen = self.color_classes[indices] != color_labels
+        if np.any(unseen):
+            raise ValueError(f"y contains previously unseen labels: {np.unique(color_labels[unseen]).tolist()}")
+        return indices
+
+    def ovo_decision(self, spectra, color_indices) -> np.ndarray:
+        """Returns the N x n_pairs one-vs-one decision values, as libsvm computes them."""
+        projected = spectra @ self.weights + self.color_offsets[color_indices]
+        if self.kernel == "linear":
+            # weights/offsets already include the SVM hyperplanes
+            return projected
+        # rbf: projected holds the PCA features, evaluate the kernel against the support vectors
+        sq_dist = (
+            np.einsum("ij,ij->i", projected, projected)[:, None]
+            - 2.0 * projected @ self.support_vectors.T
+            + np.einsum("ij,ij->i", self.support_vectors, self.support_vectors)[None, :]
+        )
+        return np.exp(-self.gamma * np.maximum(sq_dist, 0.0)) @ self.dual_coef.T + self.intercept
+
+    def predict_indices(self, ovo) -> np.ndarray:
+        """One-vs-one voting; ties go to the lowest class index as in libsvm."""
+        votes = np.zeros((ovo.shape[0], len(self.material_classes)), dtype=np.int32)
+        for k, (i, j) in enumerate(self._pairs):
+            positive = ovo[:, k] > 0
+            votes[:, i] += positive
+            votes[:, j] += ~positive
+        return np.argmax(votes, axis=1)
+
+    def ovr_scores(self, ovo) -> np.ndarray:
+        """Turns one-vs-one decision values into sklearn's 'ovr' shaped decision_function."""
+        n_classes = len(self.material_classes)
+        votes = np.zeros((ovo.shape[0], n_classes))
+        confidences = np.zeros((ovo.shape[0], n_classes))
+        for k, (i, j) in enumerate(self._pairs):
+            confidences[:, i] += ovo[:, k]
+            confidences[:, j] -= ovo[:, k]
+            votes[ovo[:, k] >= 0, i] += 1
+            votes[ovo[:, k] < 0, j] += 1
+        return votes + confidences / (3 * (np.abs(confidences) + 1))
+
+    def confidence(self, ovo, winners) -> np.ndarray:
+        """
+        Smallest one-vs-one decision value by which each winning class beat its opponents.
+
+        In SVM margin units: above 1 the sample lies outside the margin of every boundary the
+        winner was decided on, near 0 it sits on a boundary, negative means a voting tie.
+        """
+        margin = np.full(ovo.shape[0], np.inf)
+        for k, (i, j) in enumerate(self._pairs):
+            margin = np.where(winners == i, np.minimum(margin, ovo[:, k]), margin)
+            margin = np.where(winners == j, np.minimum(margin, -ovo[:, k]), margin)
+        return margin
+
+    def predict_with_confidence(self, spectra, color_indices):
+        ovo = self.ovo_decision(spectra, color_indices)
+        winners = self.predict_indices(ovo)
+        return self.material_classes[winners], self.confidence(ovo, winners)
+
+    def predict(self, spectra, color_indices, return_scores=False):
+        ovo = self.ovo_decision(spectra, color_indices)
+        materials = self.material_classes[self.predict_indices(ovo)]
+        if return_scores:
+            return materials, self.ovr_scores(ovo)
+        return materials
+
+def _pairwise_dual_coef(model):
+    """Expands libsvm's packed dual coefficients into an n_pairs x n_SV matrix."""
+    n_classes = len(model.classes_)
+    starts = np.concatenate(([0], np.cumsum(model._n_support)))
+    dual_coef = np.zeros((n_classes * (n_classes - 1) // 2, model.support_vectors_.shape[0]))
+    k = 0
+    for i in range(n_classes):
+        for j in range(i + 1, n_classes):
+            dual_coef[k, starts[i]:starts[i + 1]] = model.dual_coef_[j - 1, starts[i]:starts[i + 1]]
+            dual_coef[k, starts[j]:starts[j + 1]] = model.dual_coef_[i, starts[j]:starts[j + 1]]
+            k += 1
+    return dual_coef
+
+
+def compile_pipeline(scaler, pca, model, material_encoder, color_encoder) -> FusedModel:
+    """Compiles fitted scikit-learn objects into a FusedModel."""
+    if model.kernel not in SUPPORTED_KERNELS:
+        raise ValueError(f"Unsupported SVM kernel '{model.kernel}', expected one of {SUPPORTED_KERNELS}")
+    if getattr(pca, "whiten", False):
+        raise ValueError("Whitened PCA is not supported")
+
+    # scaler -> PCA as x @ W + b over all 19 features (18 channels + encoded color)
+    components = pca.components_.T
+    weights = components / scaler.scale_[:, None]
+    offset = -(scaler.mean_ / scaler.scale_) @ components - pca.mean_ @ components
+
+    dual_coef = _pairwise_dual_coef(model)
+    intercept = model.intercept_
+    support_vectors = model.support_vectors_
+    if model.kernel == "linear":
+        hyperplanes = dual_coef @ support_vectors
+        weights = weights @ hyperplanes.T
+        offset = offset @ hyperplanes.T + intercept
+        support_vectors = None
+        dual_coef = None
+
+    color_classes = np.asarray(color_encoder.classes_)
+    encoded_colors = color_encoder.transform(color_classes).astype(np.float64)
+    color_offsets = offset[None, :] + encoded_colors[:, None] * weights[-1][None, :]
+
+    return FusedModel(
+        kernel=model.kernel,
+        weights=weights[:-1],
+        color_offsets=color_offsets,
+        color_classes=color_classes,
+        material_classes=np.asarray(material_encoder.classes_),
+        intercept=intercept,
+        support_vectors=support_vectors,
+        dual_coef=dual_coef,
+        gamma=getattr(model, "_gamma", 0.0),
+    )
+
+
+def verify(fused, scaler, pca, model, material_encoder, color_encoder, n_samples=10000, seed=0):
+    """
+    Compares the fused engine against scikit-learn on synthetic spectra.
+
+    Returns:
+        int: Number of samples whose predicted material differs.
+    """
+    rng = np.random.default_rng(seed)
+    # Spread samples around the training distribution so every class and boundary gets exercised
+    spectra = np.abs(scaler.mean_[:-1] + rng.standard_normal((n_samples, fused.n_channels)) * scaler.scale_[:-1] * 2)
+    labels = rng.choice(color_encoder.classes_, n_samples)
+
+    combined = np.column_stack((spectra, color_encoder.transform(labels)))
+    expected = material_encoder.inverse_transform(model.predict(pca.transform(scaler.transform(combined))).astype(np.int32))
+    actual = fused.predict(spectra, fused.encode_colors(labels))
+    return int(np.count_nonzero(expected != actual))
@@ -0,0 +1,153 @@
+"""
+Bus and GPIO backends.
+
+The spectrometer driver and the plugin talk to the hardware only through these objects, so the
+real smbus2/RPi.GPIO implementations can be swapped for the in-process simulator in
+``octoprint_pfvs.simulator`` on machines without the board. Hardware modules are imported when
+a backend is created, not at import time.
+
+Backends are chosen by name: ``"hardware"`` or ``"simulator"``. The ``PFVS_BACKEND``
+environment variable overrides the name passed in by the plugin settings.
+"""
+import os
+
+HARDWARE = "hardware"
+SIMULATOR = "simulator"
+BACKENDS = (HARDWARE, SIMULATOR)
+
+
+class SMBusBackend:
+    """I2C access through smbus2 on /dev/i2c-<bus>."""
+    supports_transfer = True
+
+    def __init__(self, address, bus=1):
+        from smbus2 import SMBus, i2c_msg
+
+        self._i2c_msg = i2c_msg
+        self.address = address
+        self.i2c = SMBus(bus)
+
+    def read_byte(self, reg):
+        return self.i2c.read_byte_data(self.address, reg)
+
+    def write_byte(self, reg, data):
+        self.i2c.write_byte_data(self.address, reg, data)
+
+    def transfer(self, *ops):
+        """
+        Runs several messages as one combined (repeated start) transaction.
+
+        Each op is ``("w", [bytes])`` or ``("r", length)``. Returns the bytes of each read op in order.
+        """
+        msgs = []
+        reads = []
+        for kind, arg in ops:
+            if kind == "w":
+                msgs.append(self._i2c_msg.write(self.address, arg))
+            else:
+                msg = self._i2c_msg.read(self.address, arg)
+                msgs.append(msg)
+                reads.append(msg)
+        self.i2c.i2c_rdwr(*msgs)
+        return [list(msg) for msg in reads]
+
+    def close(self):
+        self.i2c.close()
+
+
+class RPiGPIOBackend:
+    """Digital inputs through RPi.GPIO, using physical (BOARD) pin numbers."""
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+
+        self.GPIO = GPIO
+        GPIO.setwarnings(False)
+        GPIO.setmode(GPIO.BOARD)
+        self._configured = set()
+        self._watched = set()
+
+    def setup_input(self, pin, pull_down=True):
+        if pin in self._configured:
+            return
+        self.GPIO.setup(pin, self.GPIO.IN, pull_up_down=self.GPIO.PUD_DOWN if pull_down else self.GPIO.PUD_UP)
+        self._configured.add(pin)
+
+    def read(self, pin) -> bool:
+        """Returns True if the pin reads high."""
+        self.setup_input(pin)
+        return self.GPIO.input(pin) == self.GPIO.HIGH
+
+    def watch(self, pin, callback):
+        """
+        Calls ``callback()`` from RPi.GPIO's event thread on every rising or falling edge. Raises
+        RuntimeError where the kernel refuses edge detection, callers fall back to polling then.
+        """
+        self.setup_input(pin)
+        self.GPIO.add_event_detect(pin, self.GPIO.BOTH, callback=lambda channel: callback())
+        self._watched.add(pin)
+
+    def unwatch(self, pin):
+        if pin in self._watched:
+            self.GPIO.remove_event_detect(pin)
+            self._watched.discard(pin)
+
+    def cleanup(self):
+        for pin in list(self._watched):
+            self.unwatch(pin)
+        if self._configured:
+            self.GPIO.cleanup(list(self._configured))
+            self._configured.clear()
+
+
+class SimulatedGPIO:
+    """GPIO inputs whose levels are set from code."""
+
+    def __init__(self, levels=None):
+        self.levels = dict(levels or {})
+        self._callbacks = {}
+
+    def setup_input(self, pin, pull_down=True):
+        self.levels.setdefault(pin, not pull_down)
+
+    def read(self, pin) -> bool:
+        self.setup_input(pin)
+        return bool(self.levels[pin])
+
+    def watch(self, pin, callback):
+        self.setup_input(pin)
+        self._callbacks[pin] = callback
+
+    def unwatch(self, pin):
+        self._callbacks.pop(pin, None)
+
+    def set_level(self, pin, level):
+        """Sets the pin's level, firing its edge callback if the level changed."""
+        changed = self.levels.get(pin) != bool(level)
+        self.levels[pin] = bool(level)
+        if changed and pin in self._callbacks:
+            self._callbacks[pin]()
+
+    def cleanup(self):
+        self._callbacks.clear()
+
+
+def backend_name(name=None):
+    name = os.environ.get("PFVS_BACKEND") or name or HARDWARE
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend '{name}', expected one of {BACKENDS}")
+    return name
+
+
+def create_bus_backend(address, name=None, **kwargs):
+    if backend_name(name) == SIMULATOR:
+        from octoprint_pfvs.simulator import SimulatedTriad
+
+        return SimulatedTriad(**kwargs)
+    return SMBusBackend(address, **kwargs)
+
+
+def create_gpio_backend(name=None):
+    if backend_name(name) == SIMULATOR:
+        return SimulatedGPIO()
+    return RPiGPIOBackend()
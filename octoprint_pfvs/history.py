@@ -0,0 +1,302 @@
+import io
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+HISTORY_FILE = "scans.bin"
+LABELS_FILE = "scan_labels.jsonl"
+MAGIC = b"PFVSHIST"
+VERSION = 1
+HEADER_SIZE = 16  # magic, version (u4), record size (u4)
+NUM_CHANNELS = 18
+NO_LABEL = 0
+
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<f8"),  # seconds since the epoch
+    ("material", "<u4"),  # label ids, see ScanHistory.label
+    ("job", "<u4"),
+    ("mode", "<u4"),  # "sequential" or "fixed"
+    ("confidence", "<f4"),  # NaN when the scan mode has none
+    ("target_temp", "<f4"),  # hotend target at scan time, NaN if unknown
+    ("gain", "u1"),
+    ("integration_time", "u1"),
+    ("frames", "<u2"),
+    ("dark", "<f4", (NUM_CHANNELS,)),  # raw dark reference
+    ("light", "<f4", (NUM_CHANNELS,)),  # raw combined light frames, before dark subtraction
+])
+LABEL_FIELDS = ("material", "job", "mode")
+
+
+class ScanHistory:
+    """
+    Append-only store of every scan, one fixed-size binary record per scan.
+
+    Records are ``RECORD_DTYPE`` rows after a 16 byte header, so the file can be memory mapped and
+    any page of results read without parsing the rest. Strings (materials, job names, scan
+    modes) are interned into a separate append-only label file and stored as ids.
+
+    ``append`` only queues the record; a writer thread writes queued records in batches. The
+    timestamps and materials of all records are kept in memory as the time and material index,
+    which is about 8 bytes per scan.
+    """
+    def __init__(self, folder, batch_size: int = 64, flush_interval: float = 2.0, logger=None):
+        self.path = os.path.join(folder, HISTORY_FILE)
+        self.labels_path = os.path.join(folder, LABELS_FILE)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._logger = logger or logging.getLogger("octoprint.plugins.pfvs")
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._labels = [""]
+        self._label_ids = {"": NO_LABEL}
+        self._unwritten_labels = []  # Labels of a failed write, only touched by the writer thread
+        self._stats = {"appended": 0, "written": 0, "batches": 0, "write_errors": 0}
+
+        os.makedirs(folder, exist_ok=True)
+        self._load_labels()
+        self._open()
+        self._writer = threading.Thread(target=self._write_loop, name="pfvs-history", daemon=True)
+        self._writer.start()
+
+    # ---- Opening -----
+
+    def _load_labels(self):
+        if not os.path.exists(self.labels_path):
+            return
+        complete = 0  # Bytes up to the end of the last complete label
+        with open(self.labels_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    value = json.loads(line)
+                except ValueError:
+                    break  # Torn line, everything after it is lost anyway
+                self._label_ids[value] = len(self._labels)
+                self._labels.append(value)
+                complete += len(line)
+
+        size = os.path.getsize(self.labels_path)
+        if size > complete:
+            # Cut the torn line off, or new labels would be appended onto it
+            self._logger.warning(f"Dropping {size - complete} bytes of a partial label from {self.labels_path}")
+            with open(self.labels_path, "r+b") as f:
+                f.truncate(complete)
+
+    def _open(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < HEADER_SIZE:
+            with open(self.path, "wb") as f:
+                f.write(MAGIC + np.array([VERSION, RECORD_DTYPE.itemsize], dtype="<u4").tobytes())
+
+        with open(self.path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+        version, record_size = np.frombuffer(header[len(MAGIC):], dtype="<u4")
+        if header[:len(MAGIC)] != MAGIC or version != VERSION or record_size != RECORD_DTYPE.itemsize:
+            raise ValueError(f"{self.path} is not a version {VERSION} scan history")
+
+        size = os.path.getsize(self.path) - HEADER_SIZE
+        if size % RECORD_DTYPE.itemsize:
+            # A write was cut short, drop the partial record
+            self._logger.warning(f"Dropping {size % RECORD_DTYPE.itemsize} bytes of a partial record from {self.path}")
+            with open(self.path, "r+b") as f:
+                f.truncate(HEADER_SIZE + size - size % RECORD_DTYPE.itemsize)
+
+        records = self._records()
+        self._timestamps = np.array(records["timestamp"]) if len(records) else np.empty(0)
+        self._materials = np.array(records["material"]) if len(records) else np.empty(0, dtype="<u4")
+        self._count = len(self._timestamps)
+        self._sorted = bool(np.all(np.diff(self._timestamps) >= 0))
+
+    def _records(self):
+        count = (os.path.getsize(self.path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+        if count == 0:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        return np.memmap(self.path, dtype=RECORD_DTYPE, mode="r", offset=HEADER_SIZE, shape=(count,))
+
+    # ---- Writing -----
+
+    def label(self, value) -> int:
+        """Interns a string, returns its id."""
+        value = "" if value is None else str(value)
+        with self._lock:
+            label_id = self._label_ids.get(value)
+            if label_id is None:
+                label_id = self._label_ids[value] = len(self._labels)
+                self._labels.append(value)
+                self._queue.put(("label", value))
+            return label_id
+
+    def append(self, dark, light, gain, integration_time, frames, material, confidence=None,
+               job=None, mode=None, target_temp=None, timestamp=None):
+        """Queues a scan for writing, returns immediately."""
+        record = np.zeros((), dtype=RECORD_DTYPE)
+        record["timestamp"] = time.time() if timestamp is None else timestamp
+        record["material"] = self.label(material)
+        record["job"] = self.label(job)
+        record["mode"] = self.label(mode)
+        record["confidence"] = np.nan if confidence is None else confidence
+        record["target_temp"] = np.nan if target_temp is None else target_temp
+        record["gain"] = gain
+        record["integration_time"] = integration_time
+        record["frames"] = frames
+        record["dark"] = dark
+        record["light"] = light
+        self._queue.put(("record", record))
+        with self._lock:
+            self._stats["appended"] += 1
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            # Collect more until the batch is full or flush_interval passed since the first one
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._write(batch)
+                    return
+                batch.append(item)
+            self._write(batch)
+
+    def _append_file(self, path, data):
+        """Appends ``data`` completely or, if the write fails, not at all."""
+        with open(path, "ab") as f:
+            size = f.tell()
+            try:
+                f.write(data)
+                f.flush()
+            except OSError:
+                f.truncate(size)
+                raise
+
+    def _write(self, batch):
+        # Labels are only queued once, so they stay here until they are on disk and a failed
+        # write retries them with the next batch
+        labels = self._unwritten_labels = self._unwritten_labels + [value for kind, value in batch if kind == "label"]
+        records = np.array([value for kind, value in batch if kind == "record"], dtype=RECORD_DTYPE)
+        try:
+            # Labels first, a record never refers to a label that is not on disk
+            if labels:
+                self._append_file(self.labels_path,
+                                  "".join(json.dumps(value) + "\n" for value in labels).encode("utf-8"))
+            self._unwritten_labels = []
+            if len(records):
+                self._append_file(self.path, records.tobytes())
+        except OSError as e:
+            self._logger.error(f"Error writing scan history: {e}")
+            with self._lock:
+                self._stats["write_errors"] += 1
+            return
+
+        with self._lock:
+            if len(records):
+                if self._count and records["timestamp"][0] < self._timestamps[-1]:
+                    self._sorted = False
+                self._sorted = self._sorted and bool(np.all(np.diff(records["timestamp"]) >= 0))
+                self._timestamps = np.concatenate((self._timestamps, records["timestamp"]))
+                self._materials = np.concatenate((self._materials, records["material"]))
+                self._count += len(records)
+            self._stats["written"] += len(records)
+            self._stats["batches"] += 1
+
+    def close(self, timeout: float = 5.0):
+        """Writes everything still queued and stops the writer."""
+        self._queue.put(None)
+        self._writer.join(timeout)
+
+    # ---- Queries -----
+
+    def _select(self, start=None, end=None, material=None):
+        """Positions of the matching records, oldest first."""
+        with self._lock:
+            timestamps, materials, is_sorted = self._timestamps, self._materials, self._sorted
+            material_id = self._label_ids.get(material) if material else None
+        if material and material_id is None:
+            return np.empty(0, dtype=np.int64)
+
+        if is_sorted:
+            first = 0 if start is None else int(np.searchsorted(timestamps, start, side="left"))
+            last = len(timestamps) if end is None else int(np.searchsorted(timestamps, end, side="right"))
+            positions = np.arange(first, last)
+        else:
+            mask = np.ones(len(timestamps), dtype=bool)
+            if start is not None:
+                mask &= timestamps >= start
+            if end is not None:
+                mask &= timestamps <= end
+            positions = np.flatnonzero(mask)
+
+        if material_id is not None:
+            positions = positions[materials[positions] == material_id]
+        return positions
+
+    def _to_dict(self, record, include_spectra):
+        result = {
+            "timestamp": float(record["timestamp"]),
+            "material": self._labels[record["material"]],
+            "job": self._labels[record["job"]] or None,
+            "mode": self._labels[record["mode"]] or None,
+            "confidence": None if np.isnan(record["confidence"]) else float(record["confidence"]),
+            "target_temp": None if np.isnan(record["target_temp"]) else float(record["target_temp"]),
+            "gain": int(record["gain"]),
+            "integration_time": int(record["integration_time"]),
+            "frames": int(record["frames"]),
+        }
+        if include_spectra:
+            result["dark"] = record["dark"].tolist()
+            result["light"] = record["light"].tolist()
+        return result
+
+    def query(self, start=None, end=None, material=None, offset: int = 0, limit: int = 100,
+              newest_first: bool = True, include_spectra: bool = False) -> dict:
+        """
+        One page of scans between ``start`` and ``end`` (epoch seconds, inclusive), optionally
+        only those predicted as ``material``.
+
+        Returns:
+            dict: ``total`` matching scans and the ``records`` of the requested page.
+        """
+        positions = self._select(start, end, material)
+        total = len(positions)
+        if newest_first:
+            positions = positions[::-1]
+        page = positions[offset:offset + limit]
+
+        records = self._records()
+        with self._lock:
+            return {"total": total, "offset": offset, "limit": limit,
+                    "records": [self._to_dict(records[i], include_spectra) for i in page]}
+
+    def export(self, start=None, end=None, material=None) -> bytes:
+        """The matching scans as an .npz archive with one array per field, oldest first."""
+        records = self._records()[self._select(start, end, material)]
+        with self._lock:
+            labels = np.array(self._labels)
+        arrays = {name: np.asarray(records[name]) for name in RECORD_DTYPE.names if name not in LABEL_FIELDS}
+        for name in LABEL_FIELDS:
+            arrays[name] = labels[records[name]] if len(records) else np.empty(0, dtype=labels.dtype)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        return buffer.getvalue()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["records"] = self._count
+            stats["queued"] = self._queue.qsize()
+            stats["labels"] = len(self._labels)
+            materials, counts = np.unique(self._materials, return_counts=True)
+            stats["materials"] = {self._labels[m]: int(c) for m, c in zip(materials, counts)}
+        stats["file_size"] = os.path.getsize(self.path)
+        return stats
@@ -0,0 +1,235 @@
+"""
+Single-file, versioned model bundle for the filament classifier.
+
+Layout::
+
+    magic "PFVSMODL" | format version (u4) | manifest length (u4) | manifest (UTF-8 JSON)
+    padding to 64 bytes | array payloads, each 64 byte aligned, raw little-endian C order
+
+The manifest carries the schema version, the channel count, the material and color classes,
+the kernel, a hash of the training artifacts the bundle was built from and, per array, its
+dtype, shape, offset and SHA-256. Arrays are memory mapped on load, nothing is unpickled.
+
+Building a bundle from the pickled scikit-learn objects (verifying the fused engine against
+scikit-learn first, which needs the plugin's "convert" extra)::
+
+    python -m octoprint_pfvs.model_bundle [model_dir] [output]
+"""
+import datetime
+import hashlib
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+from octoprint_pfvs.filament_gcodes import FILAMENTS
+from octoprint_pfvs.fused_model import MODEL_DIR, SUPPORTED_KERNELS, FusedModel, compile_pipeline, verify
+
+MODEL_BUNDLE_FILE = "classifier.pfvsmodel"
+MAGIC = b"PFVSMODL"
+FORMAT_VERSION = 1
+SCHEMA_VERSION = 1
+HEADER = struct.Struct("<8sII")  # magic, format version, manifest length
+ALIGNMENT = 64
+ARRAYS = ("weights", "color_offsets", "intercept", "support_vectors", "dual_coef")
+CHANNELS = 18  # AS7265x triad
+REQUIRED_COLORS = ("R",)  # color labels the plugin classifies with
+
+# Pickles the converter reads, by compile_pipeline argument
+PICKLE_FILES = {
+    "scaler": "scaler.pkl",
+    "pca": "pca.pkl",
+    "model": "svm_model.pkl",
+    "material_encoder": "material_encoder.pkl",
+    "color_encoder": "color_encoder.pkl",
+}
+
+
+class BundleError(ValueError):
+    """The file is not a model bundle this version can load, or it is damaged."""
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def training_hash(paths) -> str:
+    """SHA-256 over the contents of the training artifacts, in the given order."""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_bundle(path, model: FusedModel, training_hash: str, metadata: dict = None) -> dict:
+    """
+    Writes ``model`` as a bundle, atomically: readers see either the old file or the complete new one.
+
+    Returns:
+        dict: The manifest that was written.
+    """
+    arrays = {name: np.ascontiguousarray(getattr(model, name), dtype="<f8")
+              for name in ARRAYS if getattr(model, name) is not None}
+    manifest = {
+        "schema_version": SCHEMA_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "training_hash": training_hash,
+        "channels": int(model.n_channels),
+        "kernel": model.kernel,
+        "gamma": model.gamma,
+        "materials": [str(label) for label in model.material_classes],
+        "colors": [str(label) for label in model.color_classes],
+        "metadata": metadata or {},
+        "arrays": {},
+    }
+
+    # The offsets depend on the manifest's length and the length on the offsets, so lay out
+    # twice, leaving a spare alignment block for the offsets' digits
+    for _ in range(2):
+        encoded = json.dumps(manifest, sort_keys=True).encode("utf-8")
+        offset = _aligned(HEADER.size + len(encoded) + ALIGNMENT)
+        for name, array in arrays.items():
+            manifest["arrays"][name] = {
+                "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset,
+                "nbytes": array.nbytes, "sha256": hashlib.sha256(array.tobytes()).hexdigest(),
+            }
+            offset = _aligned(offset + array.nbytes)
+    encoded = json.dumps(manifest, sort_keys=True).encode("utf-8")
+    if HEADER.size + len(encoded) > min(entry["offset"] for entry in manifest["arrays"].values()):
+        raise BundleError("Manifest does not fit in front of the payloads")
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(encoded)))
+        f.write(encoded)
+        for name, array in arrays.items():
+            f.seek(manifest["arrays"][name]["offset"])
+            f.write(array.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return manifest
+
+
+def read_manifest(path) -> dict:
+    """Reads and checks the header and manifest without touching the payloads."""
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise BundleError(f"{path} is too short to be a model bundle")
+        magic, version, length = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise BundleError(f"{path} is not a model bundle")
+        if version != FORMAT_VERSION:
+            raise BundleError(f"{path} has bundle format {version}, this plugin reads format {FORMAT_VERSION}")
+        try:
+            manifest = json.loads(f.read(length).decode("utf-8"))
+        except ValueError as e:
+            raise BundleError(f"{path} has a damaged manifest: {e}")
+
+    if manifest.get("schema_version") != SCHEMA_VERSION:
+        raise BundleError(f"{path} has schema version {manifest.get('schema_version')}, "
+                          f"this plugin reads version {SCHEMA_VERSION}")
+    size = os.path.getsize(path)
+    for name, entry in manifest["arrays"].items():
+        if entry["offset"] + entry["nbytes"] > size:
+            raise BundleError(f"{path} is truncated, array {name} is missing")
+    return manifest
+
+
+def load_bundle(path, verify_hashes: bool = True):
+    """
+    Loads a bundle with its arrays memory mapped read-only.
+
+    Returns:
+        tuple: The FusedModel and its manifest.
+    """
+    manifest = read_manifest(path)
+    arrays = {}
+    for name, entry in manifest["arrays"].items():
+        array = np.memmap(path, dtype=np.dtype(entry["dtype"]), mode="r", offset=entry["offset"],
+                          shape=tuple(entry["shape"]))
+        # Hashed straight from the mapping, a copy would defeat the zero-copy load
+        if verify_hashes and hashlib.sha256(memoryview(array)).hexdigest() != entry["sha256"]:
+            raise BundleError(f"{path} is damaged, checksum of array {name} does not match")
+        arrays[name] = array
+
+    model = FusedModel(
+        kernel=manifest["kernel"],
+        color_classes=np.asarray(manifest["colors"]),
+        material_classes=np.asarray(manifest["materials"]),
+        gamma=manifest["gamma"],
+        **arrays
+    )
+    n_pairs = len(model.material_classes) * (len(model.material_classes) - 1) // 2
+    if model.n_channels != manifest["channels"] or model.intercept.shape != (n_pairs,):
+        raise BundleError(f"{path} does not match its manifest: {model.n_channels} channels, "
+                          f"{model.intercept.shape[0]} class pairs")
+    return model, manifest
+
+
+def check_compatible(manifest, path="bundle"):
+    """
+    Raises BundleError unless this plugin can use the bundle: the triad's channel count, a kernel
+    the engine evaluates, the color labels the plugin scans with and only materials it has
+    presets for.
+    """
+    problems = []
+    if manifest["channels"] != CHANNELS:
+        problems.append(f"{manifest['channels']} channels instead of {CHANNELS}")
+    if manifest["kernel"] not in SUPPORTED_KERNELS:
+        problems.append(f"unsupported kernel '{manifest['kernel']}'")
+    missing = [color for color in REQUIRED_COLORS if color not in manifest["colors"]]
+    if missing:
+        problems.append(f"no color {', '.join(missing)}")
+    unknown = [material for material in manifest["materials"] if material not in FILAMENTS]
+    if unknown:
+        problems.append(f"materials without presets: {', '.join(unknown)}")
+    if problems:
+        raise BundleError(f"{path} does not fit this plugin: {'; '.join(problems)}")
+
+
+def convert_pickles(model_dir=MODEL_DIR, path=None) -> dict:
+    """
+    Compiles the pickled scikit-learn pipeline into a bundle, after checking that the fused
+    engine predicts exactly what scikit-learn does.
+
+    Returns:
+        dict: The manifest that was written.
+    """
+    import joblib
+
+    paths = {name: os.path.join(model_dir, filename) for name, filename in PICKLE_FILES.items()}
+    objects = {name: joblib.load(path) for name, path in paths.items()}
+    fused = compile_pipeline(**objects)
+    mismatches = verify(fused, **objects)
+    if mismatches:
+        raise BundleError(f"Fused model disagrees with scikit-learn on {mismatches} samples")
+
+    import sklearn
+
+    return write_bundle(
+        path or os.path.join(model_dir, MODEL_BUNDLE_FILE), fused,
+        training_hash=training_hash(paths.values()),
+        metadata={"source": "pickles", "sklearn_version": sklearn.__version__},
+    )
+
+
+def main(model_dir=MODEL_DIR, path=None):
+    path = path or os.path.join(model_dir, MODEL_BUNDLE_FILE)
+    try:
+        manifest = convert_pickles(model_dir, path)
+    except BundleError as e:
+        print(f"{e}, not exporting")
+        return 1
+    print(f"Wrote {path} ({manifest['kernel']} kernel, {len(manifest['materials'])} materials, "
+          f"training hash {manifest['training_hash'][:12]}, predictions identical to scikit-learn)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:]))
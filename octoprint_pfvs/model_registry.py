@@ -0,0 +1,236 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from octoprint_pfvs.fused_model import MODEL_DIR, FusedModel
+from octoprint_pfvs.model_bundle import MODEL_BUNDLE_FILE, BundleError, check_compatible, load_bundle
+
+
+class ModelPipeline:
+    """The inference engine loaded from one consistent set of model files."""
+    def __init__(self, engine: FusedModel, source, fingerprint, load_time, manifest):
+        self.engine = engine
+        self.source = source
+        self.fingerprint = fingerprint
+        self.load_time = load_time
+        self.manifest = manifest
+        self.loaded_at = time.time()
+
+
+class ModelRegistry:
+    """
+    Keeps the classifier pipeline resident in memory and reloads it when the model files change.
+
+    A bundle installed at runtime (in ``install_dir``) is preferred, then the bundle shipped with
+    the plugin; both are memory mapped and need neither joblib nor scikit-learn. Nothing is ever
+    unpickled at runtime, the pickles are only the input of the bundle converter. ``install()``
+    validates a new bundle, moves it into place atomically and swaps it in without a restart.
+
+    The files are stat'ed at most once every ``check_interval`` seconds. A changed mtime or size
+    only triggers a reload if the SHA-256 of the files differs from the loaded set, so touching a
+    file is cheap. A failed reload (e.g. a half-copied bundle) keeps serving the previous pipeline.
+    """
+    def __init__(self, model_dir: str = MODEL_DIR, check_interval: float = 5.0, install_dir: str = None):
+        self.model_dir = model_dir
+        self.install_dir = install_dir
+        self.check_interval = check_interval
+        self._logger = logging.getLogger("octoprint.plugins.pfvs")
+        self._lock = threading.RLock()
+        self._pipeline = None
+        self._signature = None
+        self._last_check = 0.0
+        self._stats = {
+            "loads": 0,
+            "reloads": 0,
+            "failed_reloads": 0,
+            "installs": 0,
+            "cache_hits": 0,
+            "last_load_time": 0.0,
+            "total_load_time": 0.0,
+        }
+
+    def _paths(self):
+        if self.install_dir is not None and os.path.exists(os.path.join(self.install_dir, MODEL_BUNDLE_FILE)):
+            return {"bundle": os.path.join(self.install_dir, MODEL_BUNDLE_FILE)}
+        return {"bundle": os.path.join(self.model_dir, MODEL_BUNDLE_FILE)}
+
+    def _stat_signature(self):
+        signature = []
+        for path in self._paths().values():
+            st = os.stat(path)
+            signature.append((path, st.st_mtime_ns, st.st_size))
+        return tuple(signature)
+
+    def _hash_files(self):
+        digest = hashlib.sha256()
+        for path in self._paths().values():
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 16), b""):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def _load(self, fingerprint):
+        paths = self._paths()
+        start = time.perf_counter()
+        engine, manifest = load_bundle(paths["bundle"])
+        source = "installed" if os.path.dirname(paths["bundle"]) == self.install_dir else "shipped"
+        load_time = time.perf_counter() - start
+        self._stats["loads"] += 1
+        self._stats["last_load_time"] = load_time
+        self._stats["total_load_time"] += load_time
+        self._logger.info(f"Loaded {source} classifier bundle from {paths['bundle']} in {load_time * 1000:.1f} ms")
+        return ModelPipeline(engine, source, fingerprint, load_time, manifest)
+
+    def get(self) -> ModelPipeline:
+        """Returns the resident pipeline, loading or reloading it first if needed."""
+        with self._lock:
+            now = time.monotonic()
+            if self._pipeline is not None and now - self._last_check < self.check_interval:
+                self._stats["cache_hits"] += 1
+                return self._pipeline
+
+            self._last_check = now
+            try:
+                signature = self._stat_signature()
+            except OSError as e:
+                if self._pipeline is None:
+                    raise
+                self._logger.warning(f"Could not stat model files, keeping loaded pipeline: {e}")
+                self._stats["cache_hits"] += 1
+                return self._pipeline
+
+            if self._pipeline is not None and signature == self._signature:
+                self._stats["cache_hits"] += 1
+                return self._pipeline
+
+            self._refresh(signature)
+            return self._pipeline
+
+    def reload(self):
+        """Forces the model files to be re-read from disk."""
+        with self._lock:
+            self._last_check = time.monotonic()
+            self._refresh(self._stat_signature(), force=True)
+            return self._pipeline
+
+    def _refresh(self, signature, force=False):
+        fingerprint = self._hash_files()
+        if not force and self._pipeline is not None and fingerprint == self._pipeline.fingerprint:
+            # Only the timestamps changed, the contents are the same
+            self._signature = signature
+            self._stats["cache_hits"] += 1
+            return
+
+        try:
+            pipeline = self._load(fingerprint)
+            if self._stat_signature() != signature:
+                raise RuntimeError("model files changed while they were being loaded")
+        except Exception as e:
+            if self._pipeline is None:
+                self._logger.error(f"Error loading models or preprocessing tools: {e}")
+                raise
+            self._stats["failed_reloads"] += 1
+            self._logger.error(f"Error reloading models, keeping previous pipeline: {e}")
+            # Leave the signature untouched so the next check tries again
+            return
+
+        if self._pipeline is not None:
+            self._stats["reloads"] += 1
+        self._pipeline = pipeline
+        self._signature = signature
+
+    def install(self, path) -> dict:
+        """
+        Installs the bundle at ``path`` (e.g. an upload) in place of the current model.
+
+        The bundle is fully loaded and checked against its manifest and against this plugin
+        before anything is replaced, so a damaged or incompatible file raises BundleError and
+        leaves the running model untouched. It is then copied next to its final name and renamed
+        over it, and the pipeline is swapped under the registry lock: predictions in flight
+        finish on the old model, the next one uses the new. Should the swap fail after all, the
+        previously installed bundle is put back.
+
+        Returns:
+            dict: The manifest of the installed bundle.
+        """
+        if self.install_dir is None:
+            raise RuntimeError("No install directory configured for model bundles")
+        _, manifest = load_bundle(path)
+        check_compatible(manifest, path)
+
+        target = os.path.join(self.install_dir, MODEL_BUNDLE_FILE)
+        previous_path = f"{target}.previous"
+        # A temporary file of its own, concurrent installs must not copy into the same one
+        with tempfile.NamedTemporaryFile(dir=self.install_dir, prefix=f"{MODEL_BUNDLE_FILE}.", delete=False) as f:
+            with open(path, "rb") as source:
+                shutil.copyfileobj(source, f)
+            f.flush()
+            os.fsync(f.fileno())
+            tmp_path = f.name
+        with self._lock:
+            had_previous = os.path.exists(target)
+            if had_previous:
+                shutil.copyfile(target, previous_path)
+            previous = self._pipeline
+            os.replace(tmp_path, target)
+            try:
+                swapped = self.reload() is not previous
+                reason = "loading the installed copy failed"
+            except Exception as e:
+                swapped, reason = False, e
+            if not swapped:
+                # The old pipeline is still serving, so its file goes back too
+                if had_previous:
+                    os.replace(previous_path, target)
+                else:
+                    os.remove(target)
+                self._signature = None
+                raise BundleError(f"Could not swap in {path}: {reason}")
+            if had_previous:
+                os.remove(previous_path)
+            self._stats["installs"] += 1
+        self._logger.info(f"Installed model bundle {manifest['training_hash'][:12]} created {manifest['created']}")
+        return manifest
+
+    def warm_up(self) -> float:
+        """
+        Loads the pipeline and runs one throwaway prediction through it, so the first real scan
+        pays for neither. Returns the seconds spent.
+        """
+        start = time.perf_counter()
+        engine = self.get().engine
+        engine.predict(np.zeros((1, engine.n_channels)), np.zeros(1, dtype=np.intp))
+        return time.perf_counter() - start
+
+    def stats(self) -> dict:
+        """Returns load and cache statistics for the registry."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["loaded"] = self._pipeline is not None
+            if self._pipeline is not None:
+                stats["source"] = self._pipeline.source
+                stats["fingerprint"] = self._pipeline.fingerprint
+                stats["loaded_at"] = self._pipeline.loaded_at
+                manifest = self._pipeline.manifest
+                stats["bundle"] = {key: manifest[key] for key in ("schema_version", "created", "training_hash",
+                                                                  "channels", "kernel", "materials", "metadata")}
+            return stats
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> ModelRegistry:
+    """Returns the process-wide model registry."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+        return _registry
@@ -0,0 +1,181 @@
+import collections
+import threading
+import time
+
+import numpy as np
+
+OVERFLOW_POLICIES = ("merge", "drop")
+
+
+class RateMeter:
+    """Events per second over the last ``window`` ticks, a tick may stand for several events."""
+    def __init__(self, window: int = 32):
+        self._ticks = collections.deque(maxlen=window)
+
+    def tick(self, now=None, count=1):
+        self._ticks.append((time.monotonic() if now is None else now, count))
+
+    @property
+    def rate(self) -> float:
+        if len(self._ticks) < 2 or self._ticks[-1][0] == self._ticks[0][0]:
+            return 0.0
+        # The events of the first tick happened before the measured span
+        events = sum(count for _, count in self._ticks) - self._ticks[0][1]
+        return events / (self._ticks[-1][0] - self._ticks[0][0])
+
+
+class FrameRing:
+    """
+    Bounded buffer of frames between the acquisition and the inference stage.
+
+    When the consumer falls behind and the ring is full, a new frame is either averaged into the
+    newest slot ("merge", nothing is lost but the newest slot covers several frames) or the oldest
+    frame is dropped ("drop"). Either way the producer never blocks.
+    """
+    def __init__(self, capacity: int = 8, overflow: str = "merge"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow}', expected one of {OVERFLOW_POLICIES}")
+        self.capacity = max(1, int(capacity))
+        self.overflow = overflow
+        self._slots = collections.deque()  # [sum of frames, frame count, time of the first frame]
+        self._cond = threading.Condition()
+        self._stats = {"put": 0, "merged": 0, "dropped": 0}
+
+    def __len__(self):
+        with self._cond:
+            return len(self._slots)
+
+    def put(self, frame, timestamp=None):
+        frame = np.asarray(frame, dtype=np.float64)
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        with self._cond:
+            self._stats["put"] += 1
+            if len(self._slots) >= self.capacity:
+                if self.overflow == "merge":
+                    slot = self._slots[-1]
+                    slot[0] = slot[0] + frame
+                    slot[1] += 1
+                    self._stats["merged"] += 1
+                    return
+                self._slots.popleft()
+                self._stats["dropped"] += 1
+            self._slots.append([frame, 1, timestamp])
+            self._cond.notify()
+
+    def drain(self, max_items: int, timeout: float = None):
+        """
+        Waits up to ``timeout`` for at least one slot and takes up to ``max_items`` of them, oldest first.
+
+        Returns:
+            tuple: N x channels array of (averaged) frames, N frame counts and N acquisition times.
+            N is 0 if the wait timed out.
+        """
+        with self._cond:
+            if not self._slots:
+                self._cond.wait(timeout)
+            slots = [self._slots.popleft() for _ in range(min(max_items, len(self._slots)))]
+        if not slots:
+            return np.empty((0, 0)), np.empty(0, dtype=int), np.empty(0)
+        counts = np.array([count for _, count, _ in slots])
+        frames = np.array([total for total, _, _ in slots]) / counts[:, None]
+        return frames, counts, np.array([timestamp for _, _, timestamp in slots])
+
+    def wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["buffered"] = len(self._slots)
+            return stats
+
+
+class LivePipeline:
+    """
+    Continuous acquisition split into two stages that run concurrently.
+
+    A producer thread calls ``acquire()`` for one frame at a time, paced to ``frame_rate`` frames
+    per second (0 = as fast as the hardware allows), and puts the frames into a ``FrameRing``.
+    The consumer, the thread that calls ``run()``, takes everything buffered in batches of up to
+    ``max_batch`` and hands them to ``process(frames, counts)`` in one call, so inference runs
+    vectorized while the next frames are already being acquired. Both rates are measured.
+    """
+    def __init__(self, acquire, process, frame_rate: float = 4.0, capacity: int = 8, max_batch: int = 8,
+                 overflow: str = "merge"):
+        self._acquire = acquire
+        self._process = process
+        self.frame_rate = frame_rate
+        self.max_batch = max(1, int(max_batch))
+        self.ring = FrameRing(capacity, overflow)
+        self._stopped = threading.Event()
+        self._error = None
+        self._acquired = RateMeter()
+        self._processed = RateMeter()
+        self._lock = threading.Lock()
+        self._stats = {"acquired": 0, "processed": 0, "batches": 0, "last_latency": 0.0}
+
+    @property
+    def running(self) -> bool:
+        return not self._stopped.is_set()
+
+    def stop(self):
+        self._stopped.set()
+        self.ring.wake()
+
+    def run(self):
+        """Runs the consumer on the calling thread until stop(). Re-raises a producer error."""
+        producer = threading.Thread(target=self._produce, name="pfvs-live-acquire", daemon=True)
+        producer.start()
+        try:
+            while not self._stopped.is_set():
+                frames, counts, timestamps = self.ring.drain(self.max_batch, timeout=0.5)
+                if len(frames):
+                    self._consume(frames, counts, timestamps)
+        finally:
+            self.stop()
+            producer.join()
+        # Whatever was still buffered when the stream stopped
+        frames, counts, timestamps = self.ring.drain(self.ring.capacity, timeout=0)
+        if len(frames):
+            self._consume(frames, counts, timestamps)
+        if self._error is not None:
+            raise self._error
+
+    def _produce(self):
+        interval = 1.0 / self.frame_rate if self.frame_rate > 0 else 0.0
+        next_due = time.monotonic()
+        while not self._stopped.is_set():
+            try:
+                frame = self._acquire()
+            except Exception as e:
+                self._error = e
+                self.stop()
+                return
+            now = time.monotonic()
+            self.ring.put(frame, now)
+            with self._lock:
+                self._stats["acquired"] += 1
+                self._acquired.tick(now)
+            # Keep the cadence, but never try to catch up on frames that were late
+            next_due = max(next_due + interval, now)
+            self._stopped.wait(max(0.0, next_due - now))
+
+    def _consume(self, frames, counts, timestamps):
+        self._process(frames, counts)
+        now = time.monotonic()
+        with self._lock:
+            self._stats["processed"] += int(counts.sum())
+            self._stats["batches"] += 1
+            self._stats["last_latency"] = now - float(timestamps[0])
+            self._processed.tick(now, int(counts.sum()))
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["target_fps"] = self.frame_rate
+            stats["acquire_fps"] = self._acquired.rate
+            stats["process_fps"] = self._processed.rate
+            stats["mean_batch"] = stats["processed"] / stats["batches"] if stats["batches"] else 0.0
+        stats.update(self.ring.stats())
+        return stats
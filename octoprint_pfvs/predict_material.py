@@ -1,75 +1,111 @@
-import os
+import time
+
 import numpy as np
-import joblib
 import logging
+from octoprint_pfvs.model_registry import get_registry
+from octoprint_pfvs.metrics import get_metrics
+from octoprint_pfvs.tracing import traced
 
-def predict_material(spectral_data, color_label):
+NUM_CHANNELS = 18
+
+PREDICTION_SECONDS = get_metrics().histogram("pfvs_prediction_seconds", "Classifier latency per call")
+PREDICTED_SAMPLES = get_metrics().counter("pfvs_predicted_samples_total", "Spectra classified")
+
+def _prepare_samples(spectral_data, color_labels, engine):
     """
-    Predicts the filament material given spectral data and a color label.
-    
+    Validates a batch of spectra and encodes their color labels.
+
     Parameters:
-        spectral_data (list or np.array): An array of 18 spectral channel values.
-        color_label (str): A single-character string representing the filament color ('R', 'B', 'G', etc.).
-    
+        spectral_data (list or np.array): An N x 18 array of spectral channel values.
+        color_labels (str or list): N single-character color labels, or one label for every row.
+
     Returns:
-        str: Predicted filament material.
+        tuple: The N x 18 float array and the N encoded colors.
+    """
+    spectral_data = np.asarray(spectral_data, dtype=np.float64)
+    if spectral_data.ndim != 2 or spectral_data.shape[1] != NUM_CHANNELS:
+        raise ValueError(f"Spectral data must contain exactly {NUM_CHANNELS} channel values per sample.")
+
+    if isinstance(color_labels, str):
+        color_labels = [color_labels] * spectral_data.shape[0]
+    if len(color_labels) != spectral_data.shape[0]:
+        raise ValueError("Exactly one color label is required per spectral sample.")
+
+    return spectral_data, engine.encode_colors(color_labels)
+
+def _run_engine(spectral_data, color_labels, predict):
+    """
+    Validates and encodes the samples, then runs ``predict(engine, spectra, encoded_colors)`` on
+    the resident engine, timing it.
     """
     logger = logging.getLogger("octoprint.plugins.pfvs")
-    logger.setLevel(logging.DEBUG)
-    logger.debug("Starting material prediction process.")
-    
-    # Define paths
-    model_dir = os.path.dirname(os.path.abspath(__file__))
-    
-    # Load the trained model and preprocessing tools
-    try:
-        scaler = joblib.load(model_dir + '/scaler.pkl')
-        pca = joblib.load(model_dir + '/pca.pkl')
-        model = joblib.load(model_dir + '/svm_model.pkl')
-        material_encoder = joblib.load(model_dir + '/material_encoder.pkl')
-        color_encoder = joblib.load(model_dir + '/color_encoder.pkl')
-    except Exception as e:
-        logger.error(f"Error loading models or preprocessing tools: {e}")
-        raise
-    
-    # Ensure spectral data is a NumPy array
-    spectral_data = np.array(spectral_data)
-    
-    # Validate input dimensions
-    if spectral_data.shape[0] != 18:
-        raise ValueError("Spectral data must contain exactly 18 channel values.")
-    
-    # Encode the color
-    try:
-        encoded_color = color_encoder.transform([color_label])[0]
-    except Exception as e:
-        logger.error(f"Error encoding color: {e}")
-        raise
-    
-    # Combine spectral data with encoded color
-    combined_sample = np.append(spectral_data, encoded_color).reshape(1, -1)
-    
-    # Scale the combined data
-    try:
-        scaled_sample = scaler.transform(combined_sample)
-    except Exception as e:
-        logger.error(f"Error scaling data: {e}")
-        raise
-    
-    # Apply PCA
+
+    engine = get_registry().get().engine
+
     try:
-        pca_sample = pca.transform(scaled_sample) # Ensure pca_sample is float32
+        spectral_data, encoded_colors = _prepare_samples(spectral_data, color_labels, engine)
     except Exception as e:
-        logger.error(f"Error applying PCA: {e}")
+        logger.error(f"Invalid prediction input: {e}")
         raise
-    
-    # Predict material type
+
     try:
-        predicted_material_encoded = model.predict(pca_sample)
-        predicted_material_encoded = predicted_material_encoded.astype(np.int32)
-        predicted_material = material_encoder.inverse_transform(predicted_material_encoded)[0]
+        start = time.perf_counter()
+        result = predict(engine, spectral_data, encoded_colors)
+        PREDICTION_SECONDS.observe(time.perf_counter() - start)
+        PREDICTED_SAMPLES.inc(len(spectral_data))
+        return result
     except Exception as e:
         logger.error(f"Error predicting material: {e}")
         raise
-    
-    return predicted_material
+
+@traced()
+def predict_materials(spectral_data, color_labels, return_scores=False):
+    """
+    Predicts the filament material for many spectra in one vectorized pass.
+
+    Parameters:
+        spectral_data (list or np.array): An N x 18 array of spectral channel values.
+        color_labels (str or list): N color labels ('R', 'B', 'G', etc.), or a single label applied to every sample.
+        return_scores (bool): Also return the classifier's decision scores.
+
+    Returns:
+        np.array: N predicted filament materials, plus an N x n_classes array of scores if return_scores is set.
+    """
+    return _run_engine(spectral_data, color_labels,
+                       lambda engine, spectra, colors: engine.predict(spectra, colors, return_scores=return_scores))
+
+@traced()
+def predict_with_confidence(spectral_data, color_labels):
+    """
+    Predicts materials together with how clear-cut each prediction is.
+
+    Parameters:
+        spectral_data (list or np.array): An N x 18 array of spectral channel values.
+        color_labels (str or list): N color labels, or a single label applied to every sample.
+
+    Returns:
+        tuple: N predicted materials and N confidences. The confidence is the smallest SVM decision
+        margin by which the predicted material beat the others (1.0 = on the margin, <= 0 = ambiguous).
+    """
+    return _run_engine(spectral_data, color_labels,
+                       lambda engine, spectra, colors: engine.predict_with_confidence(spectra, colors))
+
+def predict_material(spectral_data, color_label):
+    """
+    Predicts the filament material given spectral data and a color label.
+
+    Parameters:
+        spectral_data (list or np.array): An array of 18 spectral channel values.
+        color_label (str): A single-character string representing the filament color ('R', 'B', 'G', etc.).
+
+    Returns:
+        str: Predicted filament material.
+    """
+    logger = logging.getLogger("octoprint.plugins.pfvs")
+    logger.debug("Starting material prediction process.")
+
+    spectral_data = np.asarray(spectral_data)
+    if spectral_data.shape != (NUM_CHANNELS,):
+        raise ValueError("Spectral data must contain exactly 18 channel values.")
+
+    return predict_materials(spectral_data.reshape(1, -1), [color_label])[0]
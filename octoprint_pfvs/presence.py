@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+
+
+class PresenceMonitor:
+    """
+    Debounced filament presence from the IR sensor.
+
+    Every edge on the sensor pin (re)arms a timer; only when the pin kept its level for
+    ``debounce`` seconds is it read again and, if presence changed, ``on_insert`` or ``on_remove``
+    called on the timer thread. A filament tip wobbling through the beam therefore produces one
+    event, not a burst. Where the GPIO backend cannot do edge detection the pin is polled every
+    ``poll_interval`` seconds instead.
+
+    Parameters:
+        gpio: A hardware GPIO backend (``read``, ``watch``, ``unwatch``).
+        pin (int): Physical pin number of the sensor.
+        active_low (bool): The sensor reads LOW when filament is present.
+    """
+    def __init__(self, gpio, pin, on_insert=None, on_remove=None, debounce: float = 0.05,
+                 active_low: bool = True, poll_interval: float = 0.5, logger=None):
+        self.gpio = gpio
+        self.pin = pin
+        self.on_insert = on_insert
+        self.on_remove = on_remove
+        self.debounce = debounce
+        self.active_low = active_low
+        self.poll_interval = poll_interval
+        self._logger = logger or logging.getLogger("octoprint.plugins.pfvs")
+        self._lock = threading.Lock()
+        self._timer = None
+        self._poller = None
+        self._stopped = threading.Event()
+        self._present = None
+        self._changed_at = None
+        self._stats = {"edges": 0, "inserts": 0, "removals": 0, "bounces": 0, "mode": None}
+
+    def _read(self) -> bool:
+        return self.gpio.read(self.pin) != self.active_low
+
+    @property
+    def present(self) -> bool:
+        """Debounced presence, without touching the pin."""
+        return bool(self._present)
+
+    def start(self):
+        """Takes the current level as the initial state (no event for it) and starts watching the pin."""
+        self._present = self._read()
+        self._changed_at = time.time()
+        try:
+            self.gpio.watch(self.pin, self._edge)
+            self._stats["mode"] = "edge"
+        except (RuntimeError, AttributeError) as e:
+            self._logger.warning(f"Edge detection unavailable on pin {self.pin} ({e}), polling it instead")
+            self._stats["mode"] = "poll"
+            self._poller = threading.Thread(target=self._poll_loop, name="pfvs-presence", daemon=True)
+            self._poller.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+        if self._stats["mode"] == "edge":
+            self.gpio.unwatch(self.pin)
+
+    def _edge(self):
+        """Runs on the GPIO event thread, so it only re-arms the debounce timer."""
+        with self._lock:
+            self._stats["edges"] += 1
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.debounce, self._settle)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _poll_loop(self):
+        while not self._stopped.wait(self.poll_interval):
+            if self._read() != self._present:
+                self._edge()
+
+    def _settle(self):
+        if self._stopped.is_set():
+            return
+        present = self._read()
+        with self._lock:
+            if present == self._present:
+                self._stats["bounces"] += 1  # The level went back before it settled
+                return
+            self._present = present
+            self._changed_at = time.time()
+            self._stats["inserts" if present else "removals"] += 1
+
+        callback = self.on_insert if present else self.on_remove
+        self._logger.info(f"Filament {'inserted' if present else 'removed'}")
+        if callback is not None:
+            try:
+                callback()
+            except Exception as e:
+                self._logger.error(f"Error handling filament {'insert' if present else 'removal'}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["present"] = self.present
+            stats["changed_at"] = self._changed_at
+            return stats
@@ -0,0 +1,254 @@
+"""
+In-process simulation of the SparkFun Triad (AS7265x) board.
+
+``SimulatedTriad`` implements the bus backend interface from ``octoprint_pfvs.hardware`` and
+speaks the same virtual register protocol as the real master device: the STATUS/WRITE/READ
+physical registers with their TX_VALID/RX_VALID handshake, DEVSEL, the per-device config,
+integration time, temperature and LED registers, and RAW/CAL data generated from a
+configurable synthetic spectrum with noise. It lets the driver, the scans and the benchmarks run
+on any Linux box.
+"""
+import errno
+import struct
+import threading
+import time
+
+import numpy as np
+
+from octoprint_pfvs import spectrometer as spect
+
+# Average of the dark-subtracted training spectra, in monotonic channel order
+DEFAULT_SPECTRUM = [742, 282, 788, 295, 505, 560, 212, 224, 120, 131, 46, 60, 20, 15, 28, 90, 30, 21]
+DEFAULT_DARK = [12] * 18
+
+GAIN_FACTORS = spect.GAIN_FACTORS
+INTEGRATION_STEP = spect.INTEGRATION_STEP
+REFERENCE_GAIN = 3
+REFERENCE_INTTIME = 63
+
+HW_TYPE = 0x40
+HW_VERSION = 0x41
+
+
+class SimulatedTriad:
+    """
+    Simulated AS7265x master with its two slave devices.
+
+    Parameters:
+        spectrum (list): 18 light counts (LEDs on) at gain 3 and integration time 63, in monotonic order.
+        dark (list): 18 dark counts (LEDs off) at the same settings.
+        noise (float): Shot noise factor, the standard deviation is ``noise * sqrt(counts)``.
+        read_noise (float): Constant standard deviation added to every channel.
+        latency_polls (int): Status reads before a written byte is consumed or read data is available.
+        time_scale (float): Multiplier on the conversion time; 0 makes every frame available instantly.
+        seed (int): Seed for the noise generator.
+    """
+    supports_transfer = True
+
+    def __init__(self, spectrum=DEFAULT_SPECTRUM, dark=DEFAULT_DARK, noise=0.5, read_noise=1.0,
+                 latency_polls=0, time_scale=1.0, temperature=30, seed=None):
+        self.noise = noise
+        self.read_noise = read_noise
+        self.latency_polls = latency_polls
+        self.time_scale = time_scale
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.RLock()
+        self.set_spectrum(spectrum, dark)
+        self.temperatures = {device: temperature for device in spect.DEVICES}
+
+        # Where each device's six channels land after the driver's reorderData, per device
+        order = spect.reorderData(list(range(18)))
+        raw_devices = ["AS72653", "AS72652", "AS72651"]                 # readRAW's device order
+        sorted_position = {unsorted: position for position, unsorted in enumerate(order)}
+        self._channels = {
+            device: [sorted_position[6 * i + k] for k in range(6)] for i, device in enumerate(raw_devices)
+        }
+
+        self.transactions = 0
+        self.factory_reset()
+
+    # ---- Test controls -----
+
+    def set_spectrum(self, spectrum, dark=None):
+        with self._lock:
+            self.spectrum = np.asarray(spectrum, dtype=np.float64)
+            if dark is not None:
+                self.dark = np.asarray(dark, dtype=np.float64)
+
+    def set_temperature(self, temperature, device=None):
+        with self._lock:
+            for name in ([device] if device else spect.DEVICES):
+                self.temperatures[name] = temperature
+
+    def factory_reset(self):
+        with self._lock:
+            self.devsel = 0
+            self.registers = {
+                device: {0x04: REFERENCE_GAIN << 4 | 2 << 2, 0x05: REFERENCE_INTTIME, 0x07: 0}
+                for device in spect.DEVICES
+            }
+            self._rx = None
+            self._rx_delay = 0
+            self._tx_delay = 0
+            self._pending_write = None
+            self._pointer = spect.STATUS_REG
+            self._frames = {}
+            self._conversion_epoch = 0
+            self._conversion_start = time.monotonic()
+            self._one_shot = False
+
+    # ---- Device model -----
+
+    def _device(self):
+        return spect.DEVICES[self.devsel] if self.devsel < len(spect.DEVICES) else spect.DEVICES[0]
+
+    def _conversion_time(self):
+        master = self.registers[spect.DEVICES[0]]
+        return master[0x05] * INTEGRATION_STEP * self.time_scale
+
+    def _restart_conversion(self):
+        self._conversion_epoch += 1
+        self._conversion_start = time.monotonic()
+
+    def _conversion_index(self):
+        """(restart count, conversions completed since the restart), the latter None if conversions are instant."""
+        conversion_time = self._conversion_time()
+        if conversion_time == 0:
+            return self._conversion_epoch, None
+        elapsed = time.monotonic() - self._conversion_start
+        if self._one_shot:
+            return self._conversion_epoch, 1 if elapsed >= conversion_time else 0
+        return self._conversion_epoch, int(elapsed // conversion_time)
+
+    def _data_ready(self):
+        _, index = self._conversion_index()
+        return index is None or index >= 1
+
+    def _counts(self, device):
+        regs = self.registers[device]
+        gain = (regs[0x04] >> 4) & 0b11
+        scale = GAIN_FACTORS[gain] / GAIN_FACTORS[REFERENCE_GAIN] * regs[0x05] / REFERENCE_INTTIME
+        leds_on = sum(1 for name in spect.DEVICES if self.registers[name][0x07] & 0b1000) / len(spect.DEVICES)
+        channels = self._channels[device]
+        mean = (self.dark[channels] + leds_on * self.spectrum[channels]) * scale
+        sigma = self.noise * np.sqrt(np.maximum(mean, 0)) + self.read_noise
+        return np.clip(np.rint(mean + self._rng.normal(0, 1, 6) * sigma), 0, 65535), max(scale, 1e-9)
+
+    def _frame(self, device, first_register):
+        # Results are latched per device, a new conversion only shows up when a read starts over at
+        # the first data register, so high and low bytes always come from the same frame
+        index = self._conversion_index()
+        cached = self._frames.get(device)
+        if cached is None or (first_register and (index[1] is None or cached[0] != index)):
+            counts, scale = self._counts(device)
+            cached = (index, counts.astype(np.int64), counts / scale * 0.035)
+            self._frames[device] = cached
+        return cached[1], cached[2]
+
+    def _read_virtual(self, addr):
+        device = self._device()
+        regs = self.registers[device]
+        if addr == 0x00:
+            return HW_TYPE
+        if addr == 0x01:
+            return HW_VERSION
+        if addr == 0x04:
+            return regs[0x04] | (spect.DATA_RDY if self._data_ready() else 0)
+        if addr in (0x05, 0x07):
+            return regs[addr]
+        if addr == 0x06:
+            return int(self.temperatures[device]) & 0xff
+        if addr == 0x4f:
+            return self.devsel
+        if 0x08 <= addr <= 0x13:
+            offset = addr - 0x08
+            raw, _ = self._frame(device, offset == 0)
+            value = int(raw[offset // 2])
+            return (value >> 8) & 0xff if offset % 2 == 0 else value & 0xff
+        if 0x14 <= addr <= 0x2b:
+            offset = addr - 0x14
+            _, cal = self._frame(device, offset == 0)
+            return struct.pack(">f", float(cal[offset // 4]))[offset % 4]
+        return 0
+
+    def _write_virtual(self, addr, data):
+        device = self._device()
+        if addr == 0x4f:
+            self.devsel = data & 0b11
+        elif addr == 0x04:
+            if data & 0x80:
+                self.factory_reset()
+                return
+            self.registers[device][0x04] = data & ~spect.DATA_RDY & 0xff
+            self._restart_conversion()
+            if device == spect.MASTER:
+                self._one_shot = (data & spect.MODE_BITS) >> 2 == spect.MODE_ONE_SHOT
+        elif addr in (0x05, 0x07):
+            self.registers[device][addr] = data
+            if addr == 0x05:
+                self._restart_conversion()
+
+    # ---- Physical registers -----
+
+    def _read_physical(self, reg):
+        if reg == spect.STATUS_REG:
+            if self._tx_delay > 0:
+                self._tx_delay -= 1
+            if self._rx is not None and self._rx_delay > 0:
+                self._rx_delay -= 1
+            status = 0
+            if self._tx_delay > 0:
+                status |= spect.TX_VALID
+            if self._rx is not None and self._rx_delay == 0:
+                status |= spect.RX_VALID
+            return status
+        if reg == spect.READ_REG:
+            data = self._rx if self._rx is not None else 0
+            self._rx = None
+            return data
+        return 0
+
+    def _write_physical(self, reg, data):
+        if reg != spect.WRITE_REG:
+            return
+        self._tx_delay = self.latency_polls
+        if self._pending_write is not None:
+            addr, self._pending_write = self._pending_write, None
+            self._write_virtual(addr, data)
+        elif data & 0x80:
+            self._pending_write = data & 0x7f
+        else:
+            self._rx = self._read_virtual(data)
+            self._rx_delay = self.latency_polls
+
+    # ---- Backend interface -----
+
+    def read_byte(self, reg):
+        with self._lock:
+            self.transactions += 1
+            return self._read_physical(reg)
+
+    def write_byte(self, reg, data):
+        with self._lock:
+            self.transactions += 1
+            self._write_physical(reg, data)
+
+    def transfer(self, *ops):
+        # Like the Pi's i2c-bcm2835: at most one read, and only as the last message
+        if any(kind == "r" for kind, _ in ops[:-1]):
+            raise OSError(errno.EOPNOTSUPP, "Combined transfer with a read before the last message")
+        with self._lock:
+            self.transactions += 1
+            reads = []
+            for kind, arg in ops:
+                if kind == "w":
+                    self._pointer = arg[0]
+                    if len(arg) > 1:
+                        for data in arg[1:]:
+                            self._write_physical(self._pointer, data)
+                else:
+                    reads.append([self._read_physical(self._pointer) for _ in range(arg)])
+            return reads
+
+    def close(self):
+        pass
@@ -4,9 +4,15 @@
 # File so good they made a second one
 # Original by LiamsGitHub
 
-from smbus2 import SMBus											# Module for I2C
+import logging
+import struct
 import time
 
+import numpy as np
+
+from octoprint_pfvs import hardware								# Bus backends (smbus2 or simulator)
+from octoprint_pfvs.tracing import traced						# Spans for the scan traces, free while tracing is off
+
 # ---- Globals / Constants -----
 
 I2C_ADDR =		0x49
@@ -18,101 +24,315 @@ READ_REG =		0x02
 TX_VALID =		0x02
 RX_VALID =		0x01
 
-POLLING_DELAY = 0.005											# 5mS delay to prevent swamping the slave's I2C port
-i2c = SMBus(1)													# Indicates /dev/i2c-1
+DEVICES =		["AS72651", "AS72652", "AS72653"]
+DEVSELbits =	{"AS72651":0b00, "AS72652": 0b01, "AS72653": 0b10}
 
+CONFIG_REG =	0x04
+INTTIME_REG =	0x05
+LED_REG =		0x07
+DATA_RDY =		0x02											# Config register bit set by the device, never shadowed
+MODE_BITS =		0b00001100										# Config register BANK bits, measurement mode
+MODE_CONTINUOUS =	2											# All 6 channels of every device, continuously
+MODE_ONE_SHOT =	3												# All 6 channels of every device, once per config write
+MASTER =		"AS72651"										# Owns the measurement mode and the data ready bit
 
-# ---- Low level functions -----
+INTEGRATION_STEP = 0.0028										# 2.8mS per integration time unit
+GAIN_FACTORS =	[1.0, 3.7, 16.0, 64.0]							# Amplification per gain setting 0-3
+DATA_READY_CYCLES = 2											# Worst case integration cycles per conversion, used for the timeout
+DATA_READY_MARGIN = 0.05										# Slack on top of the conversion time before giving up
+GAIN_SETTLE_TIME = 0.02											# Extra time allowed for the first conversion after a gain change
 
-# Low level function to read a Master register over I2C
-# Input variables: addr (Int)
-# Legal input values: n/a
-# Returns: data (int)
-def readReg(addr):
+POLLING_DELAY = 0.005											# 5mS delay to prevent swamping the slave's I2C port
+backend = None													# Opened on first use, see getBackend()
 
-	status = i2c.read_byte_data(I2C_ADDR,STATUS_REG)			# Do a dummy read to ensure FIFO queue is empty
-	if ((status & RX_VALID) != 0):								# There is data to be read
-		incoming = i2c.read_byte_data(I2C_ADDR,READ_REG)		# Read it to clear the queue and dump it
 
-	while (1):
+# ---- Device state -----
 
-		status = i2c.read_byte_data(I2C_ADDR,STATUS_REG)		# Poll Slave Status register
+# Mirror of what we last wrote to the board, so that writes which would not change anything and
+# DEVSEL writes for the device that is already selected can be skipped. A value of None means
+# unknown: the next access reads it from the device. Anything that can change registers behind
+# our back (factory reset, bus errors) must call invalidate().
+class DeviceState:
 
-		if ((status & TX_VALID) == 0):							# Wait for OK to transmit
-			break
+	def __init__(self):
+		self.invalidate()
 
-		#time.sleep(POLLING_DELAY)								# Polling delay to avoid drowning Slave
+	def invalidate(self):
+		self.devsel = None
+		self.shadow = {device: {} for device in DEVICES}
+		self.skippedWrites = 0
+		self.skippedDevsel = 0
+		self.gainChanged = True									# A conversion after a gain change may take longer
+		self.conversionStarted = None							# time.monotonic() of the running one-shot conversion, None if none or unknown
 
-	i2c.write_byte_data(I2C_ADDR, WRITE_REG, addr)				# send to Write register the Virtual Register address
+	def devicesFrom(self, devices):
+		# Same devices, rotated so that the currently selected one comes first
+		if self.devsel in devices:
+			i = devices.index(self.devsel)
+			return devices[i:] + devices[:i]
+		return list(devices)
 
-	while (1):
-		status = i2c.read_byte_data(I2C_ADDR,STATUS_REG)		# Poll Slave Status register
+state = DeviceState()
 
-		if ((status & RX_VALID) != 0):							# Wait for data to be present
-			break
-		#time.sleep(0.05)										# Polling delay to avoid drowning Slave
 
-	data = i2c.read_byte_data(I2C_ADDR,READ_REG)				# Finally pick up the data
+# Forget all cached register values (e.g. after a reset or when something else drove the bus)
+# Input variables: none
+# Legal input values: none
+# Returns: none
+def invalidateState():
+	state.invalidate()
+	return
+
 
-	return data
+# ---- Bus backend -----
 
-# Low level function to write to a Master register over I2C
-# Input variables: addr (Int), data (Int)
+# Use the given bus backend (hardware.SMBusBackend, simulator.SimulatedTriad, ...) from now on
+# Input variables: newBackend (backend object)
 # Legal input values: n/a
 # Returns: none
-def writeReg(addr,data):
+def setBackend(newBackend):
+	global backend
+	backend = newBackend
+	state.invalidate()											# The new bus says nothing about the old device's registers
+	return
 
-	while (1):
+# Return the bus backend, opening the hardware bus (/dev/i2c-1) if none was set
+# Input variables: none
+# Legal input values: none
+# Returns: backend object
+def getBackend():
+	global backend
+	if backend is None:
+		backend = hardware.create_bus_backend(I2C_ADDR)
+	return backend
 
-		status = i2c.read_byte_data(I2C_ADDR,STATUS_REG)		# Poll Slave Status register
 
-		if ((status & TX_VALID) == 0):							# Wait for OK to transmit
-			break
+# ---- Transaction layer -----
 
-		#time.sleep(POLLING_DELAY)
+# Every register access goes through the helpers below so the bus traffic can be counted.
+# With COMBINED_TRANSFERS each "write a byte, then read back the status register" step is a single
+# combined (repeated start, i2c_rdwr) transaction instead of two separate SMBus calls.
+# The Pi's i2c-bcm2835 only takes combined transfers whose one read message comes last, so every
+# combined transfer is writes followed by a single read. A bus that rejects them anyway
+# (OSError from transfer()) is switched to plain byte access for good.
+COMBINED_TRANSFERS = True
 
-	i2c.write_byte_data(I2C_ADDR, WRITE_REG, addr | 0x80) 		# Send Virtual Register address to Write register 
+busStats = {"transactions": 0, "statusPolls": 0, "registerReads": 0, "registerWrites": 0, "combinedFallbacks": 0}
+lastFrameStats = {}
 
-	while (1):
-		status = i2c.read_byte_data(I2C_ADDR,STATUS_REG)		# Poll Slave Status register
 
-		if ((status & TX_VALID) == 0): 							# Ready for the write
-			break
-			
-		#time.sleep(POLLING_DELAY)
+# Return a copy of the bus counters, optionally resetting them
+# Input variables: reset (Bool)
+# Legal input values: True, False
+# Returns: dict
+def getBusStats(reset=False):
+	stats = dict(busStats)
+	stats["skippedWrites"] = state.skippedWrites
+	stats["skippedDevsel"] = state.skippedDevsel
+	if (reset):
+		for key in busStats:
+			busStats[key] = 0
+		state.skippedWrites = 0
+		state.skippedDevsel = 0
+	return (stats)
+
+# Record the transactions and time spent on the frame that started at (startTransactions, startTime)
+def _recordFrame(startTransactions, startTime):
+	lastFrameStats["transactions"] = busStats["transactions"] - startTransactions
+	lastFrameStats["duration"] = time.monotonic() - startTime
+	return
 
-	i2c.write_byte_data(I2C_ADDR,WRITE_REG,data)				# Do the write
+# Single status register read
+def _readStatus():
+	busStats["transactions"] += 1
+	busStats["statusPolls"] += 1
+	return getBackend().read_byte(STATUS_REG)
+
+# Write one byte to a physical register
+def _writeByte(reg,data):
+	busStats["transactions"] += 1
+	getBackend().write_byte(reg,data)
 	return
 
-# Calibrated data comes back as IEEE754 encoded number (sign/mantissa/fraction). Need to convert to a float. Spec page 27.
-# Input variables: [Int] list of 4 Ints
+# Write one byte to a physical register, then read the status register. Returns status (int)
+def _writeThenStatus(reg,data):
+	bus = getBackend()
+	if (COMBINED_TRANSFERS and bus.supports_transfer):
+		busStats["transactions"] += 1
+		try:
+			status, = bus.transfer(("w", [reg,data]), ("w", [STATUS_REG]), ("r", 1))
+			return status[0]
+		except OSError as e:
+			bus.supports_transfer = False						# Not supported by this bus, never try again
+			busStats["combinedFallbacks"] += 1
+			logging.getLogger("octoprint.plugins.pfvs").warning(f"Combined I2C transfers failed ({e}), using plain byte access")
+
+	_writeByte(reg,data)
+	return _readStatus()
+
+# Read one byte from a physical register, then read the status register. Returns (data, status)
+# Note: The data read already ends the transfer, a second read in the same one is not portable,
+# so the status is always read on its own
+def _readThenStatus(reg):
+	busStats["transactions"] += 1
+	data = getBackend().read_byte(reg)
+	return (data, _readStatus())
+
+# Poll the status register until the slave is ready to receive (TX_VALID clear)
+def _waitTX(status):
+	return _poll(status, TX_VALID, 0, "TX ready")
+
+# Poll the status register until data is waiting in the READ register (RX_VALID set)
+def _waitRX(status):
+	return _poll(status, RX_VALID, RX_VALID, "RX data")
+
+
+# ---- Status polling -----
+
+# Raised when the slave does not become ready before the poll deadline
+class SpectrometerTimeout(Exception):
+	pass
+
+# How to wait for a status bit: spin (back to back status reads) for `spin` polls, then sleep
+# between polls starting at `initialDelay` and multiplying by `backoff` up to `maxDelay`.
+# Gives up with SpectrometerTimeout once `deadline` seconds have passed.
+class PollStrategy:
+
+	def __init__(self, spin=20, initialDelay=0.0002, maxDelay=POLLING_DELAY, backoff=2.0, deadline=0.5):
+		self.spin = spin
+		self.initialDelay = initialDelay
+		self.maxDelay = maxDelay
+		self.backoff = backoff
+		self.deadline = deadline
+
+pollStrategy = PollStrategy()
+
+# Polls needed per wait, bucketed by upper bound (last bucket catches everything above)
+POLL_BUCKETS = [0, 1, 2, 4, 8, 16, 64, 256]
+pollStats = {"waits": 0, "iterations": 0, "maxIterations": 0, "timeouts": 0, "histogram": [0] * (len(POLL_BUCKETS) + 1)}
+
+
+# Replace the polling strategy used by every register access
+# Input variables: strategy (PollStrategy)
 # Legal input values: n/a
-# Returns: Float
-def IEEE754toFloat(valArray):
+# Returns: PollStrategy. The previous strategy
+def setPollStrategy(strategy):
+	global pollStrategy
+	previous = pollStrategy
+	pollStrategy = strategy
+	return (previous)
+
+# Return a copy of the polling counters, optionally resetting them
+# Input variables: reset (Bool)
+# Legal input values: True, False
+# Returns: dict
+def getPollStats(reset=False):
+	stats = dict(pollStats)
+	stats["histogram"] = list(zip([str(b) for b in POLL_BUCKETS] + ["more"], pollStats["histogram"]))
+	if (reset):
+		pollStats.update({"waits": 0, "iterations": 0, "maxIterations": 0, "timeouts": 0, "histogram": [0] * (len(POLL_BUCKETS) + 1)})
+	return (stats)
+
+def _recordPolls(iterations):
+	pollStats["waits"] += 1
+	pollStats["iterations"] += iterations
+	pollStats["maxIterations"] = max(pollStats["maxIterations"], iterations)
+	for i, bound in enumerate(POLL_BUCKETS):
+		if iterations <= bound:
+			pollStats["histogram"][i] += 1
+			return
+	pollStats["histogram"][-1] += 1
+
+# Wait until (status & mask) == ready, following the current PollStrategy
+def _poll(status, mask, ready, what):
+	if ((status & mask) == ready):
+		_recordPolls(0)
+		return status
+
+	strategy = pollStrategy
+	deadline = time.monotonic() + strategy.deadline
+	delay = strategy.initialDelay
+	iterations = 0
 
-	c0 = valArray[0]
-	c1 = valArray[1]
-	c2 = valArray[2]
-	c3 = valArray[3]
-	
-	fullChannel = (c0 <<24) | (c1 << 16) | (c2 << 8) | (c3)
+	while (1):
+		status = _readStatus()									# Poll Slave Status register
+		iterations += 1
+		if ((status & mask) == ready):
+			break
+
+		if (time.monotonic() >= deadline):
+			_recordPolls(iterations)
+			pollStats["timeouts"] += 1
+			raise SpectrometerTimeout(f"Timed out waiting for {what} after {iterations} polls (status 0x{status:02x})")
+
+		if (iterations >= strategy.spin):						# Back off to avoid drowning Slave
+			time.sleep(delay)
+			delay = min(delay * strategy.backoff, strategy.maxDelay)
+
+	_recordPolls(iterations)
+	return status
+
+
+# ---- Low level functions -----
+
+# Read a list of virtual registers back to back
+# Input variables: addrs [Int]
+# Legal input values: n/a
+# Returns: [Int] one byte per address
+# Note: The FIFO only needs flushing once per batch, and the status read that follows each byte
+# tells us straight away whether the next address can be sent, so no extra polls are needed when
+# the slave keeps up.
+def readRegs(addrs):
 
-	sign = ((1 << 31) & (fullChannel)) >> 31
-	sign = (-1) ** sign
+	status = _readStatus()										# Do a dummy read to ensure FIFO queue is empty
+	if ((status & RX_VALID) != 0):								# There is data to be read
+		incoming, status = _readThenStatus(READ_REG)			# Read it to clear the queue and dump it
+
+	values = []
+	for addr in addrs:
+		status = _waitTX(status)								# Wait for OK to transmit
+		status = _writeThenStatus(WRITE_REG, addr)				# send to Write register the Virtual Register address
+		status = _waitRX(status)								# Wait for data to be present
+		data, status = _readThenStatus(READ_REG)				# Pick up the data
+		values.append(data)
+
+	busStats["registerReads"] += len(addrs)
+	return values
+
+# Low level function to read a Master register over I2C
+# Input variables: addr (Int)
+# Legal input values: n/a
+# Returns: data (int)
+def readReg(addr):
 
-	exponent = (fullChannel >> 23) & (0xff)
-	frac = fullChannel & 0x7fffff 								# filter out all but bottom 22 bits (fraction)
+	return readRegs([addr])[0]
 
-	accum = 1
+# Low level function to write to a Master register over I2C
+# Input variables: addr (Int), data (Int)
+# Legal input values: n/a
+# Returns: none
+def writeReg(addr,data):
 
-	for bit in range(22,-1,-1):
-		if (frac & (1<<bit)):
-			bitfrac = 1/float(2 ** (23 - bit))
-			accum = accum + bitfrac
+	status = _waitTX(_readStatus())								# Wait for OK to transmit
+	status = _writeThenStatus(WRITE_REG, addr | 0x80)			# Send Virtual Register address to Write register 
+	_waitTX(status)												# Ready for the write
+	_writeByte(WRITE_REG,data)									# Do the write
+	busStats["registerWrites"] += 1
+	return
 
-	floatVal = sign * accum * (2 ** (exponent - 127))
+# Calibrated data comes back as IEEE754 encoded number (sign/mantissa/fraction). Need to convert to a float. Spec page 27.
+# Input variables: [Int] list of 4 Ints, most significant byte first
+# Legal input values: n/a
+# Returns: Float
+def IEEE754toFloat(valArray):
+	return (struct.unpack(">f", bytes(valArray[:4]))[0])
 
-	return floatVal
+# Decode a run of big-endian IEEE754 floats in one go
+# Input variables: [Int] list of bytes, a multiple of 4 long
+# Legal input values: n/a
+# Returns: np.ndarray of Float64
+def decodeFloats(data):
+	return (np.frombuffer(bytes(data), dtype=">f4").astype(np.float64))
 
 # Set the DEVSEL register 0X4F to point to the sensor that we want
 # Input variables: (String) device name
@@ -121,16 +341,54 @@ def IEEE754toFloat(valArray):
 # Note: There is a BUG in the AS firmware: you CAN'T to read/modify/write. Doesn't work. Just overwrite whole register.
 def setDEVSEL(device):
 
-	DEVSELbits = {"AS72651":0b00, "AS72652": 0b01, "AS72653": 0b10}
-
 	try:
 		mode = DEVSELbits[device]
 	except:
 		print ("DEVSEL bad device name")
 		return (False)
 
+	if (state.devsel == device):								# Already pointing at it
+		state.skippedDevsel += 1
+		return (True)
+
+	state.devsel = None											# Unknown until the write went through
 	writeReg(0x4f, mode)
+	state.devsel = device
+
+	return (True)
+
+# Read a per-device config register, from the shadow copy when we know it
+# Input variables: device (String), reg (Int)
+# Legal input values: device {"AS72651","AS72652","AS72653"}
+# Returns: Int
+def readConfig(device, reg):
+
+	value = state.shadow[device].get(reg)
+	if value is None:
+		setDEVSEL(device)
+		value = readReg(reg)
+		if (reg == CONFIG_REG):
+			value = value & ~DATA_RDY & 0xff
+		state.shadow[device][reg] = value
+	return value
+
+# Write a per-device config register unless the shadow copy says it already holds that value
+# Input variables: device (String), reg (Int), value (Int), force (Bool)
+# Legal input values: device {"AS72651","AS72652","AS72653"}
+# Returns: Bool. True if a write was needed
+# Note: force writes even an unchanged value, writing the config register is what starts a conversion
+def writeConfig(device, reg, value, force=False):
+
+	if (not force and state.shadow[device].get(reg) == value):
+		state.skippedWrites += 1
+		return (False)
 
+	state.shadow[device][reg] = None							# Unknown until the write went through
+	if (device == MASTER):
+		state.conversionStarted = None							# Any master write restarts or alters a running conversion
+	setDEVSEL(device)
+	writeReg(reg, value)
+	state.shadow[device][reg] = value
 	return (True)
 	
 # Frequencies of sensors when read out serially are not in ascending order due to overlapping sensor bandwidths. Re-order data.
@@ -147,6 +405,8 @@ def reorderData(unsortedData):
 
 	return (sortedData)
 
+SORT_ORDER = reorderData(list(range(18)))						# reorderData as an index array, for NumPy data
+
 
 # ---- Spec functions -----
 
@@ -157,6 +417,7 @@ def reorderData(unsortedData):
 def init():
 
 	writeReg(0x04,1)
+	state.invalidate()											# Factory reset puts every register back to its default
 	time.sleep(3)		# Experience was the on-board firmware needs a 2s delay after factory reset to get ready. If you poll it immediately you get [Errno 121] Remote I/O error
 
 	return
@@ -193,6 +454,7 @@ def swVersion():
 # Input variables: void
 # Legal input values:
 # Returns: [int, int, int]
+@traced()
 def temperatures():
 	devices = ["AS72651", "AS72652", "AS72653"]
 	temps = []
@@ -204,51 +466,60 @@ def temperatures():
 
 
 # Set master blue LED state (device 1 on IND line)
-# Input variables: state (Bool)
+# Input variables: ledState (Bool)
 # Legal input values: True, False
 # Returns: Bool. True if OK.
-def setBlueLED(state):
-
-	setDEVSEL("AS72651")	# Blue LED attached to this device so need to select it first
+def setBlueLED(ledState):
 
-	currentState = readReg(0x07)
+	currentState = readConfig("AS72651", LED_REG)	# Blue LED attached to this device
 
-	if (state):
+	if (ledState):
 		newState = (currentState | 0b1 )
 	else:
 		newState = (currentState & 0b11111110 )
 
-	writeReg(0x07,newState)
+	writeConfig("AS72651", LED_REG, newState)
 	return (True)
     
 
 # Switch on/off shutter individual LEDs attached to sensor DRV lines
-# Input variables: device (String), state (Bool)
-# Legal input values: device {"AS72651","AS72652","AS72653"}, state{True, False}
-def shutterLED(device,state):
-
-	DEVSELbits = {"AS72651":0b00, "AS72652": 0b01, "AS72653": 0b10}
+# Input variables: device (String), ledState (Bool)
+# Legal input values: device {"AS72651","AS72652","AS72653"}, ledState{True, False}
+def shutterLED(device,ledState):
 
 	try:
 		mode = DEVSELbits[device]
 		
-		# print ("Debug: LEDMode = " + str(mode) + ", " + str(state))
+		# print ("Debug: LEDMode = " + str(mode) + ", " + str(ledState))
 	except:
 		print ("Bad device name")
 		return (False)
 		
-	setDEVSEL(device)
-	currentState = readReg(0x07)
+	currentState = readConfig(device, LED_REG)
 	
-	if (state == True):
+	if (ledState == True):
 		newState = (currentState | 0b1000)
 	else:
 		newState = (currentState & 0b11110111)
 		
-	writeReg(0x07,newState)
+	writeConfig(device, LED_REG, newState)
 	
 	return (True)
 
+# Switch all shutter LEDs on/off with as few bus operations as possible: the currently selected
+# device goes first so its DEVSEL write is skipped, and devices already in the right state are not touched
+# Input variables: ledState (Bool), devices [String]
+# Legal input values: ledState {True, False}
+# Returns: Bool. True if OK.
+@traced()
+def shutterLEDs(ledState, devices=DEVICES):
+
+	for device in state.devicesFrom(list(devices)):
+		if not shutterLED(device, ledState):
+			return (False)
+
+	return (True)
+
 
 # Set LED drive current for all shutter LEDs together
 # Input variables: current (Int)
@@ -268,11 +539,10 @@ def setLEDDriveCurrent(current, device):
         return (False)
 
     # for device in devices:
-    setDEVSEL(device)
-    configReg = readReg(0x07)
+    configReg = readConfig(device, LED_REG)
     configReg = ( configReg & 0b11001111 )
     configReg = configReg | (current << 4)
-    writeReg(0x07, configReg)
+    writeConfig(device, LED_REG, configReg)
 
     return (True)
 
@@ -281,17 +551,15 @@ def setLEDDriveCurrent(current, device):
 # Input variables: time (Int)
 # Legal input values: 0 to 255
 # Returns: Bool. True if OK.
+@traced()
 def setIntegrationTime(time):
 
-	devices = ["AS72651", "AS72652", "AS72653"]
-	
 	if time not in range(0,255):
 		print ("Illegal integration time setting")
 		return (False)
 
-	for device in devices:
-		setDEVSEL(device)
-		writeReg(0x05, time)
+	for device in state.devicesFrom(DEVICES):
+		writeConfig(device, INTTIME_REG, time)
 		
 	# for device in devices:
 		# setDEVSEL(device)
@@ -304,20 +572,19 @@ def setIntegrationTime(time):
 # Input variables: gain (Int) 
 # Legal input values:  0, 1, 2, 3 where b00=1x; b01=3.7x; b10=16x; b11=64x
 # Returns: Bool. True if OK.
+@traced()
 def setGain(gain):
 
-	devices = ["AS72651", "AS72652", "AS72653"]
-	
 	if gain not in [0, 1, 2, 3]:
 		print ("Illegal gain setting")
 		return (False)
 
-	for device in devices:
-		setDEVSEL(device)
-		configReg = readReg(0x04)
+	for device in state.devicesFrom(DEVICES):
+		configReg = readConfig(device, CONFIG_REG)
 		configReg = ( configReg & 0b11001111 )
 		configReg = configReg | (gain << 4)
-		writeReg(0x04, configReg)
+		if writeConfig(device, CONFIG_REG, configReg):
+			state.gainChanged = True
 		
 	# for device in devices:
 		# setDEVSEL(device)
@@ -330,19 +597,27 @@ def setGain(gain):
 # Input variables: none
 # Legal input values:  none
 # Returns: [Int] list of 18 Int values
+@traced()
 def readRAW():
 
 	RAWRegisters = [(0x08, 0x09), (0x0a, 0x0b), (0x0c, 0x0d), (0x0e, 0x0f), (0x10, 0x11), (0x12, 0x13)]
+	RAWAddrs = [reg for regPair in RAWRegisters for reg in regPair]
 	RAWValues = []
 	devices = ["AS72653", "AS72652", "AS72651"]
+	deviceValues = {}
+	startTransactions = busStats["transactions"]
+	startTime = time.monotonic()
 	
-	for device in devices:
+	for device in state.devicesFrom(devices):					# Start with the selected device to save a DEVSEL write
 		setDEVSEL(device)
 
-		for regPair in RAWRegisters:
-			highVal = readReg(regPair[0])
-			lowVal = readReg(regPair[1])
-			RAWValues.append( (highVal << 8) | (lowVal) )
+		data = readRegs(RAWAddrs)
+		deviceValues[device] = [(data[i] << 8) | (data[i+1]) for i in range(0, len(data), 2)]
+
+	for device in devices:
+		RAWValues.extend(deviceValues[device])
+
+	_recordFrame(startTransactions, startTime)
 
 # now reorder the data to be in monotonic frequency order
 	output = reorderData(RAWValues)
@@ -354,26 +629,140 @@ def readRAW():
 # Read all 18 calibrated values together
 # Input variables: none
 # Legal input values:  none
-# Returns: [Int] list of 18 Int values
+# Returns: np.ndarray of 18 Float64 values, in monotonic frequency order
+@traced()
 def readCAL():
 
 	CALRegisters = [(0x14,0x15,0x16,0x17),(0x18,0x19,0x1a,0x1b),(0x1c,0x1d,0x1e,0x1f),(0x20,0x21,0x22,0x23),(0x24,0x25,0x26,0x27),(0x28,0x29,0x2a,0x2b)]
-	CALValues = []
+	CALAddrs = [reg for regQuad in CALRegisters for reg in regQuad]
 	devices = ["AS72651", "AS72652", "AS72653"]
+	deviceBytes = {}
+	startTransactions = busStats["transactions"]
+	startTime = time.monotonic()
 	
-	for device in devices:
+	for device in state.devicesFrom(devices):					# Start with the selected device to save a DEVSEL write
 		setDEVSEL(device)
+		deviceBytes[device] = readRegs(CALAddrs)
 
-		for regQuad in CALRegisters:
-			cal0 = readReg(regQuad[0])
-			cal1 = readReg(regQuad[1])
-			cal2 = readReg(regQuad[2])
-			cal3 = readReg(regQuad[3])
-			floatval = IEEE754toFloat([cal0,cal1,cal2,cal3])
-			CALValues.append(floatval)
+	CALBytes = [byte for device in devices for byte in deviceBytes[device]]
+	_recordFrame(startTransactions, startTime)
 
-# now reorder the data to be in monotonic frequency order
-	output = reorderData(CALValues)
-	#print output
+# decode all 18 floats at once, then reorder the data to be in monotonic frequency order
+	return (decodeFloats(CALBytes)[SORT_ORDER])
 
-	return (output)
+
+# ---- Measurement control -----
+
+measureStats = {"measurements": 0, "polls": 0, "timeouts": 0, "lastWait": 0.0, "lastExpected": 0.0}
+
+# Set the measurement (BANK) mode of the master device
+# Input variables: mode (Int)
+# Legal input values: 0, 1, 2, 3 (MODE_CONTINUOUS, MODE_ONE_SHOT)
+# Returns: Bool. True if OK.
+@traced()
+def setMeasurementMode(mode):
+
+	if mode not in [0, 1, 2, 3]:
+		print ("Illegal measurement mode")
+		return (False)
+
+	configReg = readConfig(MASTER, CONFIG_REG)
+	writeConfig(MASTER, CONFIG_REG, (configReg & ~MODE_BITS & 0xff) | (mode << 2))
+	return (True)
+
+# Time one conversion takes at the current integration time
+# Input variables: none
+# Legal input values: none
+# Returns: Float. Seconds
+def conversionTime():
+	return (readConfig(MASTER, INTTIME_REG) * INTEGRATION_STEP)
+
+# Longest we wait for data ready before deciding the board is stuck
+# Input variables: none
+# Legal input values: none
+# Returns: Float. Seconds
+def dataReadyTimeout():
+	timeout = conversionTime() * DATA_READY_CYCLES + DATA_READY_MARGIN
+	if (state.gainChanged):
+		timeout += GAIN_SETTLE_TIME
+	return (timeout)
+
+# Return whether a finished conversion is waiting to be read
+# Input variables: none
+# Legal input values: none
+# Returns: Bool
+def dataReady():
+	setDEVSEL(MASTER)
+	return (bool(readReg(CONFIG_REG) & DATA_RDY))
+
+# Start a one-shot conversion of all 18 channels. Clears DATA_RDY, the device sets it when done.
+# Input variables: none
+# Legal input values: none
+# Returns: Float. time.monotonic() when the conversion started, see conversionRunning()
+@traced()
+def startMeasurement():
+	configReg = readConfig(MASTER, CONFIG_REG)
+	writeConfig(MASTER, CONFIG_REG, (configReg & ~MODE_BITS & 0xff) | (MODE_ONE_SHOT << 2), force=True)
+	state.conversionStarted = time.monotonic()
+	return (state.conversionStarted)
+
+# Return whether the conversion startMeasurement() started at startedAt is still running or waiting
+# to be read, i.e. no master register write restarted it and no waitDataReady() consumed it since
+# Input variables: startedAt (Float) as returned by startMeasurement
+# Legal input values: n/a
+# Returns: Bool
+def conversionRunning(startedAt):
+	return (startedAt is not None and state.conversionStarted == startedAt)
+
+# Wait until the device reports data ready
+# Input variables: timeout (Float) seconds, None to derive it from the integration time and gain
+# Legal input values: n/a
+# Returns: Float. Seconds waited
+# Note: Sleeps through what remains of the expected conversion time first, polling any earlier would
+# only cost bus traffic. A conversion started a while ago (e.g. while the caller did other work) is
+# polled right away.
+@traced()
+def waitDataReady(timeout=None):
+
+	expected = conversionTime()
+	if (timeout is None):
+		timeout = dataReadyTimeout()
+	start = time.monotonic()
+	elapsed = start - state.conversionStarted if state.conversionStarted is not None else 0.0
+	deadline = start + max(timeout - elapsed, DATA_READY_MARGIN)
+
+	time.sleep(max(0.0, expected - elapsed))
+	polls = 1
+	while (not dataReady()):
+		if (time.monotonic() >= deadline):
+			measureStats["timeouts"] += 1
+			raise SpectrometerTimeout(f"Timed out waiting for data ready after {polls} polls ({timeout:.3f}s)")
+		time.sleep(POLLING_DELAY)
+		polls += 1
+
+	waited = time.monotonic() - start
+	state.gainChanged = False
+	state.conversionStarted = None								# Consumed, the next wait needs a new conversion
+	measureStats["measurements"] += 1
+	measureStats["polls"] += polls
+	measureStats["lastWait"] = waited
+	measureStats["lastExpected"] = expected
+	return (waited)
+
+# Take one measurement and wait for it, the results are then ready for readRAW/readCAL
+# Input variables: timeout (Float) seconds, None to derive it from the integration time and gain
+# Legal input values: n/a
+# Returns: Float. Seconds waited
+def takeMeasurement(timeout=None):
+	startMeasurement()
+	return (waitDataReady(timeout))
+
+# Return a copy of the measurement counters, optionally resetting them
+# Input variables: reset (Bool)
+# Legal input values: True, False
+# Returns: dict
+def getMeasureStats(reset=False):
+	stats = dict(measureStats)
+	if (reset):
+		measureStats.update({"measurements": 0, "polls": 0, "timeouts": 0, "lastWait": 0.0, "lastExpected": 0.0})
+	return (stats)
@@ -0,0 +1,118 @@
+"""
+Deferred plugin initialization.
+
+OctoPrint imports and instantiates the plugin while it boots, so nothing on that path may touch
+NumPy, the I2C bus or the classifier. Those modules are referenced through ``LazyModule`` and
+loaded by the plugin's background init thread, which reports its progress in a ``Readiness``.
+"""
+import importlib
+import threading
+import time
+
+INITIALIZING = "initializing"
+READY = "ready"
+FAILED = "failed"
+
+
+class LazyModule:
+    """Stands in for a module that is imported on first attribute access, or explicitly with load()."""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def load(self):
+        if self._module is None:
+            # The import system's own module locks make concurrent first accesses safe
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self.load(), attr)
+
+    def __repr__(self):
+        return f"<LazyModule {self._name}{'' if self.loaded else ' (not loaded)'}>"
+
+
+class _Step:
+    def __init__(self, readiness, name):
+        self._readiness = readiness
+        self._name = name
+
+    def __enter__(self):
+        with self._readiness._lock:
+            self._readiness._step = self._name
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._readiness._lock:
+            self._readiness._steps[self._name] = time.monotonic() - self._start
+        if exc_type is not None:
+            self._readiness.set_failed(f"{self._name}: {exc}")
+        return False
+
+
+class Readiness:
+    """
+    State of the plugin's background initialization: initializing, ready or failed (with a reason).
+
+    Hooks and routes check ``state`` instead of waiting, only jobs on the arbiter thread wait for it.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._state = INITIALIZING
+        self._reason = None
+        self._step = None
+        self._steps = {}
+        self._started = time.monotonic()
+        self._finished = None
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @property
+    def ready(self) -> bool:
+        return self._state == READY
+
+    @property
+    def reason(self):
+        return self._reason
+
+    def step(self, name):
+        """Context manager timing one initialization step, an exception in it marks the plugin failed."""
+        return _Step(self, name)
+
+    def set_ready(self):
+        with self._lock:
+            if self._state == FAILED:
+                return
+            self._state = READY
+            self._step = None
+            self._finished = time.monotonic()
+        self._ready.set()
+
+    def set_failed(self, reason):
+        with self._lock:
+            if self._state == FAILED:
+                return  # Keep the first, root cause
+            self._state = FAILED
+            self._reason = str(reason)
+            self._finished = time.monotonic()
+        self._ready.set()
+
+    def wait(self, timeout=None) -> bool:
+        """Blocks until initialization finished or ``timeout`` passed, returns True if the plugin is ready."""
+        self._ready.wait(timeout)
+        return self.ready
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            end = self._finished if self._finished is not None else time.monotonic()
+            return {"state": self._state, "reason": self._reason, "step": self._step,
+                    "steps": dict(self._steps), "elapsed": end - self._started}
@@ -5,10 +5,67 @@
  * License: AGPLv3
  */
 $(function() {
+    // AS7265x channel centers in nm, in the order the plugin sends them
+    var WAVELENGTHS = [410, 435, 460, 485, 510, 535, 560, 585, 610, 645, 680, 705, 730, 760, 810, 860, 900, 940];
+
+    // Unpacks a spectrum sent by the plugin's SpectrumPublisher ("json", "q16" or "f32")
+    function decodeSpectrum(packed) {
+        if (packed.encoding === "json") return packed.data;
+
+        var raw = atob(packed.data);
+        var bytes = new Uint8Array(raw.length);
+        for (var i = 0; i < raw.length; i++) bytes[i] = raw.charCodeAt(i);
+        var view = new DataView(bytes.buffer);
+
+        var values = [];
+        if (packed.encoding === "f32") {
+            for (var j = 0; j < bytes.length; j += 4) values.push(view.getFloat32(j, true));
+        } else if (packed.encoding === "q16") {
+            for (var k = 0; k < bytes.length; k += 2) values.push(packed.offset + view.getUint16(k, true) * packed.scale);
+        }
+        return values;
+    }
+
+    // Bar chart on a canvas, redrawn at most once per animation frame however often data arrives
+    function SpectrumChart(canvas) {
+        var self = this;
+        var pending = null;
+        var scheduled = false;
+
+        self.update = function (values) {
+            pending = values;
+            if (scheduled) return;
+            scheduled = true;
+            window.requestAnimationFrame(function () {
+                scheduled = false;
+                self.draw(pending);
+            });
+        };
+
+        self.draw = function (values) {
+            if (!canvas || !values || !values.length) return;
+            var ctx = canvas.getContext("2d");
+            var width = canvas.width, height = canvas.height, axis = 16;
+            var max = Math.max.apply(null, values.concat([1]));
+            var slot = width / values.length;
+
+            ctx.clearRect(0, 0, width, height);
+            ctx.font = "9px sans-serif";
+            ctx.textAlign = "center";
+            for (var i = 0; i < values.length; i++) {
+                var barHeight = Math.max(0, values[i]) / max * (height - axis - 4);
+                ctx.fillStyle = "#4CAF50";
+                ctx.fillRect(i * slot + 2, height - axis - barHeight, slot - 4, barHeight);
+                ctx.fillStyle = "#333";
+                ctx.fillText(WAVELENGTHS[i] || i, i * slot + slot / 2, height - 4);
+            }
+        };
+    }
+
     function PfvsViewModel(parameters) {
         var self = this;
 
-        self.spectrometerData = ko.observableArray([]);
+        self.chart = new SpectrumChart(document.getElementById("pfvs_spectrum_chart"));
         self.isSpectrometerRunning = ko.observable(false);
         self.predictedMaterial = ko.observable("");
 
@@ -44,11 +101,12 @@ $(function() {
         self.onDataUpdaterPluginMessage = function (plugin, data) {
             if (plugin !== "pfvs") return;
 
-            if (data.spectrometer_data) {
-                self.spectrometerData(data.spectrometer_data);
+            if (data.spectrum) {
+                self.chart.update(decodeSpectrum(data.spectrum));
             }
 
-            if (data.predicted_material) {  // Update predicted material
+            // Update predicted material, an empty string clears it (filament removed)
+            if ("predicted_material" in data && data.predicted_material !== null) {
                 self.predictedMaterial(data.predicted_material);
             }
         };
@@ -0,0 +1,138 @@
+import base64
+import threading
+import time
+
+import numpy as np
+
+ENCODINGS = ("json", "q16", "f32")
+
+
+def encode_spectrum(spectrum, encoding: str = "json") -> dict:
+    """
+    Packs a spectrum for a plugin message.
+
+    "json" is a plain list rounded to 0.1 counts. "q16" quantizes linearly between the minimum
+    and maximum to 16 bits and base64 encodes them little-endian (value = offset + q * scale),
+    "f32" base64 encodes little-endian float32. The packed forms have a fixed size whatever the
+    magnitude of the counts, 48 and 96 characters for 18 channels.
+    """
+    spectrum = np.asarray(spectrum, dtype=np.float64)
+    if encoding == "json":
+        return {"encoding": "json", "data": np.round(spectrum, 1).tolist()}
+    if encoding == "f32":
+        return {"encoding": "f32", "data": base64.b64encode(spectrum.astype("<f4").tobytes()).decode("ascii")}
+    if encoding == "q16":
+        offset = round(float(spectrum.min()), 1)
+        # Six significant digits keep the header short, rounding up so the maximum still fits
+        scale = float(f"{(float(spectrum.max()) - offset) / 65535 * (1 + 1e-5):.6g}") or 1.0
+        quantized = np.clip(np.rint((spectrum - offset) / scale), 0, 65535).astype("<u2")
+        return {"encoding": "q16", "data": base64.b64encode(quantized.tobytes()).decode("ascii"),
+                "offset": offset, "scale": scale}
+    raise ValueError(f"Unknown encoding '{encoding}', expected one of {ENCODINGS}")
+
+
+def decode_spectrum(packed: dict) -> np.ndarray:
+    """Inverse of encode_spectrum, the web UI does the same in JavaScript."""
+    encoding = packed["encoding"]
+    if encoding == "json":
+        return np.asarray(packed["data"], dtype=np.float64)
+    raw = base64.b64decode(packed["data"])
+    if encoding == "f32":
+        return np.frombuffer(raw, dtype="<f4").astype(np.float64)
+    if encoding == "q16":
+        return packed["offset"] + np.frombuffer(raw, dtype="<u2") * packed["scale"]
+    raise ValueError(f"Unknown encoding '{encoding}', expected one of {ENCODINGS}")
+
+
+class SpectrumPublisher:
+    """
+    Rate limited publisher for live spectra.
+
+    Frames arriving faster than ``max_rate`` pushes per second are averaged into the next push
+    instead of being sent one by one. A push whose spectrum moved less than ``min_change``
+    (relative to its brightest channel) and whose prediction did not change is dropped, but at
+    least one push goes out every ``keepalive`` seconds so new clients catch up.
+
+    Parameters:
+        send (callable): Called with the payload dict, e.g. a send_plugin_message partial.
+    """
+    def __init__(self, send, max_rate: float = 2.0, encoding: str = "q16", min_change: float = 0.01,
+                 keepalive: float = 5.0):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown encoding '{encoding}', expected one of {ENCODINGS}")
+        self._send = send
+        self.max_rate = max_rate
+        self.encoding = encoding
+        self.min_change = min_change
+        self.keepalive = keepalive
+        self._lock = threading.Lock()
+        self._sum = None
+        self._count = 0
+        self._material = None
+        self._extra = {}
+        self._last_flush = None
+        self._last_sent = None
+        self._last_spectrum = None
+        self._last_material = None
+        self._sequence = 0
+        self._stats = {"frames": 0, "published": 0, "coalesced": 0, "suppressed": 0}
+
+    def publish(self, spectrum, material=None, **extra) -> bool:
+        """Adds a frame, returns True if it caused a push."""
+        with self._lock:
+            spectrum = np.asarray(spectrum, dtype=np.float64)
+            if self._sum is None:
+                self._sum = spectrum.copy()
+            else:
+                self._sum += spectrum
+            self._count += 1
+            self._material = material
+            self._extra = extra
+            self._stats["frames"] += 1
+
+            interval = 1.0 / self.max_rate if self.max_rate > 0 else 0.0
+            if self._last_flush is not None and time.monotonic() - self._last_flush < interval:
+                self._stats["coalesced"] += 1
+                return False
+            return self._flush()
+
+    def flush(self) -> bool:
+        """Pushes whatever is pending regardless of the rate, e.g. when the stream stops."""
+        with self._lock:
+            return self._flush()
+
+    def _flush(self) -> bool:
+        if self._count == 0:
+            return False
+        spectrum = self._sum / self._count
+        frames = self._count
+        self._sum = None
+        self._count = 0
+
+        now = self._last_flush = time.monotonic()
+        if (self._last_spectrum is not None and self._material == self._last_material
+                and now - self._last_sent < self.keepalive):
+            reference = max(float(np.max(np.abs(self._last_spectrum))), 1.0)
+            if float(np.max(np.abs(spectrum - self._last_spectrum))) <= self.min_change * reference:
+                self._stats["suppressed"] += 1
+                return False
+
+        self._sequence += 1
+        payload = {
+            "spectrum": encode_spectrum(spectrum, self.encoding),
+            "predicted_material": self._material,
+            "frames": frames,
+            "sequence": self._sequence,
+        }
+        payload.update(self._extra)
+        self._send(payload)
+
+        self._last_sent = now
+        self._last_spectrum = spectrum
+        self._last_material = self._material
+        self._stats["published"] += 1
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,174 @@
+"""
+Lightweight span tracing for the scan pipeline.
+
+A trace is started with ``tracer.trace(name)`` and every ``tracer.span(name)`` (or function
+decorated with ``@traced()``) entered on the same thread while it runs is recorded as a span of
+it, with its start offset, duration and nesting depth. Finished traces are kept in a ring buffer.
+
+Tracing is off by default. While it is off, ``trace``/``span`` return a shared no-op context
+manager and ``@traced`` functions cost one attribute check, so the instrumentation can stay in
+the hot paths. Spans entered outside of a trace are not recorded either.
+"""
+import collections
+import functools
+import threading
+import time
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Trace:
+    def __init__(self, name):
+        self.name = name
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.spans = []
+        self.depth = 0
+
+
+class Span:
+    __slots__ = ("_tracer", "_trace", "name", "attrs", "start", "depth")
+
+    def __init__(self, tracer, trace, name, attrs):
+        self._tracer = tracer
+        self._trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """Adds attributes to the span, e.g. results only known inside the block."""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.depth = self._trace.depth
+        self._trace.depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        trace = self._trace
+        trace.depth -= 1
+        span = {
+            "name": self.name,
+            "depth": self.depth,
+            "start_ms": (self.start - trace.start) * 1e3,
+            "duration_ms": (end - self.start) * 1e3,
+        }
+        if exc_type is not None:
+            span["error"] = repr(exc)
+        if self.attrs:
+            span.update(self.attrs)
+        trace.spans.append(span)
+        return False
+
+
+class _RootSpan(Span):
+    __slots__ = ()
+
+    def __exit__(self, exc_type, exc, tb):
+        super().__exit__(exc_type, exc, tb)
+        self._tracer._finish(self._trace)
+        return False
+
+
+class Tracer:
+    """Records traces of the current thread into a ring buffer of the last ``capacity`` traces."""
+    def __init__(self, capacity: int = 50, enabled: bool = False):
+        self.enabled = enabled
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._traces = collections.deque(maxlen=capacity)
+        self._dropped = 0
+
+    @property
+    def capacity(self) -> int:
+        return self._traces.maxlen
+
+    def configure(self, enabled=None, capacity=None):
+        with self._lock:
+            if capacity is not None and capacity != self._traces.maxlen:
+                self._traces = collections.deque(self._traces, maxlen=max(1, int(capacity)))
+            if enabled is not None:
+                self.enabled = bool(enabled)
+
+    def trace(self, name, **attrs):
+        """Starts a trace, or a span if this thread is already inside one."""
+        if not self.enabled:
+            return NULL_SPAN
+        trace = getattr(self._local, "trace", None)
+        if trace is not None:
+            return Span(self, trace, name, attrs)
+        trace = self._local.trace = _Trace(name)
+        return _RootSpan(self, trace, name, attrs)
+
+    def span(self, name, **attrs):
+        """A span of the trace running on this thread, a no-op outside of one."""
+        if not self.enabled:
+            return NULL_SPAN
+        trace = getattr(self._local, "trace", None)
+        if trace is None:
+            return NULL_SPAN
+        return Span(self, trace, name, attrs)
+
+    def _finish(self, trace):
+        self._local.trace = None
+        root = trace.spans.pop()
+        result = {"name": trace.name, "thread": threading.current_thread().name, "started_at": trace.started_at}
+        # Duration, error and attributes of the root span describe the whole trace
+        result.update((key, value) for key, value in root.items() if key not in ("name", "depth", "start_ms"))
+        result["spans"] = sorted(trace.spans, key=lambda span: span["start_ms"])
+        with self._lock:
+            if len(self._traces) == self._traces.maxlen:
+                self._dropped += 1
+            self._traces.append(result)
+
+    def traces(self, limit=None, name=None) -> list:
+        """Finished traces, newest first."""
+        with self._lock:
+            traces = [trace for trace in reversed(self._traces) if name is None or trace["name"] == name]
+        return traces[:limit] if limit is not None else traces
+
+    def clear(self):
+        with self._lock:
+            self._traces.clear()
+            self._dropped = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"enabled": self.enabled, "capacity": self._traces.maxlen,
+                    "traces": len(self._traces), "dropped": self._dropped}
+
+
+tracer = Tracer()
+
+
+def traced(name=None, root=False):
+    """
+    Decorator recording every call of the function as a span, or with ``root`` as a trace of its
+    own (a span when called inside another trace).
+    """
+    def decorate(fn):
+        span_name = name or fn.__name__
+        start = tracer.trace if root else tracer.span
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return fn(*args, **kwargs)
+            with start(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
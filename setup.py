@@ -36,11 +36,9 @@ plugin_license = "AGPLv3"
 plugin_requires = [
     "smbus2",
     "numpy",
-    "joblib",
     "octoprint",
     "flask",
     "RPi.GPIO",
-    "scikit-learn"
 ]
 
 ### --------------------------------------------------------------------------------------------------------------------
@@ -69,7 +67,9 @@ plugin_ignored_packages = []
 #     additional_setup_parameters = {"dependency_links": ["https://github.com/someUser/someRepo/archive/master.zip#egg=someDependency-dev"]}
 # "python_requires": ">=3,<4" blocks installation on Python 2 systems, to prevent confused users and provide a helpful error. 
 # Remove it if you would like to support Python 2 as well as 3 (not recommended).
-additional_setup_parameters = {"python_requires": ">=3,<4"}
+# The "convert" extra is only needed to build model bundles from the pickled scikit-learn pipeline.
+additional_setup_parameters = {"python_requires": ">=3,<4",
+                               "extras_require": {"convert": ["joblib", "scikit-learn"]}}
 
 ########################################################################################################################
 